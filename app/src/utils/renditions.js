@@ -0,0 +1,26 @@
+/**
+ * Pick, of each format, the narrowest rendition wide enough to fill `cssWidth`,
+ * smallest file first, to be offered as `<source>`s by their MIME type, so that
+ * the browser takes the first format it supports. Empty if none is wide enough,
+ * so that the caller falls back to its own source.
+ */
+export function pickRenditions(renditions, cssWidth, maxWidth = Infinity) {
+  const width = Math.min(cssWidth * (window.devicePixelRatio || 1), maxWidth)
+  const byFormat = {}
+  for (const r of renditions || []) {
+    if (r.width >= width && !(byFormat[r.format]?.width <= r.width)) {
+      byFormat[r.format] = r
+    }
+  }
+  return Object.values(byFormat).sort((a, b) => a.size - b.size)
+}
+
+/**
+ * `<source>`s of renditions, as `ImageAsync` takes them.
+ */
+export function renditionSources(renditions) {
+  return renditions.map((r) => ({
+    srcset: `${import.meta.env.VITE_IMG_FETCH_BASE}/${r.uri}`,
+    type: `image/${r.format}`,
+  }))
+}
@@ -6,7 +6,7 @@ from flask import Flask
 from flask_wtf import CSRFProtect
 from flask_cors import CORS
 
-from . import commands, blueprints
+from . import commands, blueprints, media, metrics, storage
 from .models import db
 
 
@@ -20,6 +20,9 @@ def create_app():
     commands.init_app(app)
     db.init_app(app)
     blueprints.init_app(app)
+    storage.init_app(app)
+    media.init_app(app)
+    metrics.init_app(app)
 
     @app.context_processor
     def make_template_context():
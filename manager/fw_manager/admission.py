@@ -0,0 +1,159 @@
+"""Admission control of decoding images, across the worker processes.
+
+Decoding expands an upload into a bitmap of hundreds of MB, so decodes hold
+slots, `ADMISSION_SLOTS` of them in all, each standing for a budget of
+`ADMISSION_SLOT_PIXELS` pixels. Slots are files in `ADMISSION_FOLDER` locked
+by `flock`, which are released by the OS even if a worker dies. A request
+waits for slots up to `ADMISSION_TIMEOUT` seconds, then it is answered 503
+with `Retry-After`. Slots in use and requests waiting for them are reported
+by `state`, which counts marker files locked by the requests rather than
+taking the slots.
+"""
+
+import fcntl
+import math
+import os
+import random
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO
+from uuid import uuid4
+
+from flask import current_app
+from loguru import logger
+from werkzeug.exceptions import ServiceUnavailable
+
+from . import metrics
+
+ADMISSION_FOLDER = os.environ.get("ADMISSION_FOLDER", "")
+ADMISSION_SLOTS = int(os.environ.get("ADMISSION_SLOTS", 2))
+ADMISSION_SLOT_PIXELS = int(os.environ.get("ADMISSION_SLOT_PIXELS", 50_000_000))
+ADMISSION_TIMEOUT = float(os.environ.get("ADMISSION_TIMEOUT", 10))
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 5))
+ADMISSION_POLL_INTERVAL = 0.05
+
+
+def admission_folder() -> Path:
+    folder = Path(ADMISSION_FOLDER or Path(current_app.instance_path) / "admission")
+    folder.mkdir(exist_ok=True, parents=True)
+    return folder
+
+
+def _lock(path: Path) -> IO | None:
+    """Lock a file without blocking, returns it open if locked."""
+    file = path.open("a")
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        file.close()
+        return None
+    return file
+
+
+def _release(files: list[IO]) -> None:
+    for file in files:
+        fcntl.flock(file, fcntl.LOCK_UN)
+        file.close()
+
+
+@contextmanager
+def _marked(folder: Path, prefix: str):
+    """Mark a request by a file it keeps locked, which `state` counts. The file
+    is locked before it gets the name `state` looks for, so `state` only ever
+    takes the markers of dead workers."""
+    tmp_path = folder / f".{uuid4().hex}"
+    file = tmp_path.open("a")
+    fcntl.flock(file, fcntl.LOCK_EX)
+    path = folder / f"{prefix}-{os.getpid()}-{uuid4().hex}.lock"
+    tmp_path.rename(path)
+    try:
+        yield
+    finally:
+        path.unlink(missing_ok=True)
+        _release([file])
+
+
+def slots_for(pixels: int) -> int:
+    return min(max(math.ceil(pixels / ADMISSION_SLOT_PIXELS), 1), ADMISSION_SLOTS)
+
+
+def _try_acquire(folder: Path, count: int) -> list[IO] | None:
+    # all or none of them, so that no two waiters hold a part each
+    held = []
+    offset = random.randrange(ADMISSION_SLOTS)
+    for i in range(ADMISSION_SLOTS):
+        file = _lock(folder / f"slot-{(offset + i) % ADMISSION_SLOTS}.lock")
+        if file is not None:
+            held.append(file)
+            if len(held) == count:
+                return held
+    _release(held)
+    return None
+
+
+@contextmanager
+def admit(pixels: int, timeout: float | None = ADMISSION_TIMEOUT):
+    """Hold slots for decoding an image of so many pixels.
+
+    Waits up to `timeout` seconds, or for good if None, then raises 503.
+    """
+    folder = admission_folder()
+    count = slots_for(pixels)
+    start = time.monotonic()
+    held = _try_acquire(folder, count)
+    if held is None:
+        # a marker per waiter, which tells the queue depth
+        with _marked(folder, "waiting"):
+            logger.info(f"Waiting for {count} decode slot(s)...")
+            while held is None:
+                if timeout is not None and time.monotonic() - start >= timeout:
+                    metrics.inc("fw_admission_rejected_total")
+                    logger.warning("No decode slot available, rejected.")
+                    raise ServiceUnavailable(retry_after=ADMISSION_RETRY_AFTER)
+                time.sleep(ADMISSION_POLL_INTERVAL * random.uniform(0.5, 1.5))
+                held = _try_acquire(folder, count)
+    metrics.observe("fw_admission_wait_seconds", time.monotonic() - start)
+    try:
+        with _marked(folder, f"holding-{count}"):
+            yield
+    finally:
+        _release(held)
+
+
+def _live_markers(folder: Path, prefix: str) -> list[Path]:
+    """Markers of requests still waiting or holding, the ones left by workers
+    which died are deleted."""
+    live = []
+    for path in folder.glob(f"{prefix}-*.lock"):
+        file = _lock(path)
+        if file is None:
+            live.append(path)
+        else:
+            path.unlink(missing_ok=True)
+            _release([file])
+    return live
+
+
+def state() -> dict:
+    """Slots in use and requests waiting for them, across the processes.
+
+    The slots are never locked to tell, so scrapes don't hold decodes back.
+    """
+    folder = admission_folder()
+    # named as `holding-<slots>-<pid>-<id>.lock`
+    in_use = sum(int(p.name.split("-")[1]) for p in _live_markers(folder, "holding"))
+    waiting = len(_live_markers(folder, "waiting"))
+    return {"slots": ADMISSION_SLOTS, "in_use": in_use, "waiting": waiting}
+
+
+metrics.gauge(
+    "fw_admission_slots_in_use",
+    "Decode slots in use.",
+    lambda: state()["in_use"],
+)
+metrics.gauge(
+    "fw_admission_waiting",
+    "Requests waiting for decode slots.",
+    lambda: state()["waiting"],
+)
@@ -0,0 +1,226 @@
+"""Async (ASGI) serving of the public gallery, i.e. `GET /images`.
+
+It answers just as `retriever_bp` does, from the same catalog snapshot, but
+reads the database by an async driver through a pool of connections, so that
+one event loop keeps up with many visitors at once. It runs next to the WSGI
+app on the same database and instance folder, e.g.
+
+    uvicorn fw_manager.asgi:app --port 5001
+
+with the gallery, and nothing else, routed to it by an exact match, e.g. by
+nginx
+
+    location = /api/images {
+        proxy_pass http://127.0.0.1:5001/images;
+    }
+
+since the other paths under `/images`, e.g. `/images/manifest` and
+`/images/<id>/placeholder`, are left to the WSGI app. The database is the one
+configured for the WSGI app, reached by the async driver of its dialect,
+e.g. `aiosqlite` for SQLite.
+"""
+
+import asyncio
+import importlib
+import json
+import os
+import time
+from urllib.parse import parse_qsl
+
+from flask import Flask
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.engine import URL
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException, MethodNotAllowed, NotFound
+from werkzeug.http import is_resource_modified
+from werkzeug.wrappers import Response
+
+from . import catalog, database, metrics
+from .blueprints.retriever import _get_images, _set_cache_headers
+from .models import db
+from .utils import make_resp
+
+ASYNC_POOL_SIZE = int(os.environ.get("ASYNC_POOL_SIZE", 10))
+ASYNC_MAX_OVERFLOW = int(os.environ.get("ASYNC_MAX_OVERFLOW", 10))
+
+# async driver of each dialect
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg", "mysql": "aiomysql"}
+
+# error code and message of each status, as answered by `error_bp`
+ERRORS = {
+    400: ("BAD_REQUEST", "Bad request"),
+    404: ("NOT_FOUND", "404 not found"),
+    405: ("METHOD_NOT_ALLOWED", "Method not allowed"),
+    500: ("INTERNAL_ERROR", "An error occurred"),
+}
+
+
+def async_url(url: URL) -> URL:
+    """The database URL with the async driver of its dialect."""
+    backend = url.get_backend_name()
+    driver = ASYNC_DRIVERS.get(backend)
+    if driver is None:
+        raise RuntimeError(f"No async driver is known for `{backend}`.")
+    try:
+        importlib.import_module(driver)
+    except ImportError as err:
+        raise RuntimeError(f"`{driver}` is required by the async retriever.") from err
+    return url.set(drivername=f"{backend}+{driver}")
+
+
+def _error_response(status: int) -> Response:
+    err_code, msg = ERRORS.get(status, ERRORS[500])
+    body = make_resp(err_code=err_code, msg=msg)
+    return Response(json.dumps(body), status, mimetype="application/json")
+
+
+class Retriever:
+    """ASGI app of the gallery, with a catalog snapshot of its own."""
+
+    def __init__(self, flask_app: Flask | None = None):
+        self.flask_app = flask_app
+        self.engine: AsyncEngine | None = None
+        self.snapshot: catalog.Snapshot | None = None
+        self._snapshot_lock = asyncio.Lock()
+
+    def setup(self) -> None:
+        """Create the engine, from the configuration of the WSGI app."""
+        if self.flask_app is None:
+            from . import create_app
+
+            self.flask_app = create_app()
+        with self.flask_app.app_context():
+            # as resolved by Flask-SQLAlchemy, e.g. SQLite paths in the instance
+            url = db.engine.url
+        self.engine = create_async_engine(
+            async_url(url),
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=ASYNC_POOL_SIZE,
+            max_overflow=ASYNC_MAX_OVERFLOW,
+        )
+        if url.get_backend_name() == "sqlite":
+            event.listen(
+                self.engine.sync_engine,
+                "connect",
+                lambda dbapi_conn, _: database.set_pragmas(dbapi_conn),
+            )
+        logger.info(f"Async retriever on {self.engine.url!r}.")
+
+    async def close(self) -> None:
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        if self.engine is None:
+            self.setup()
+
+        start = time.perf_counter()
+        resp = await self._respond(scope)
+        duration = time.perf_counter() - start
+        resp.headers["Server-Timing"] = f"total;dur={duration * 1000:.1f}"
+        await send(
+            {
+                "type": "http.response.start",
+                "status": resp.status_code,
+                "headers": [
+                    (k.lower().encode("latin-1"), v.encode("latin-1"))
+                    for k, v in resp.headers.items()
+                ],
+            }
+        )
+        body = b"" if scope["method"] == "HEAD" else resp.get_data()
+        await send({"type": "http.response.body", "body": body})
+
+        metrics.observe(
+            "fw_http_request_duration_seconds",
+            duration,
+            method=scope["method"],
+            endpoint="asgi.get_images",
+            status=resp.status_code,
+        )
+        assert self.flask_app is not None
+        with self.flask_app.app_context():
+            metrics.flush()
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.setup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _respond(self, scope) -> Response:
+        try:
+            if scope["path"].rstrip("/") != "/images":
+                raise NotFound()
+            if scope["method"] not in ("GET", "HEAD"):
+                raise MethodNotAllowed(["GET", "HEAD"])
+            return await self.get_images(scope)
+        except HTTPException as err:
+            return _error_response(err.code or 500)
+        except Exception as err:
+            logger.error(f"An error occurred: {err!r}")
+            return _error_response(500)
+
+    async def get_images(self, scope) -> Response:
+        """Fetch images in JSON, conditionally by the catalog generation."""
+        headers = {
+            k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]
+        }
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "HTTP_IF_NONE_MATCH": headers.get("if-none-match", ""),
+            "HTTP_IF_MODIFIED_SINCE": headers.get("if-modified-since", ""),
+        }
+        query = scope["query_string"].decode()
+        args = MultiDict(parse_qsl(query, keep_blank_values=True))
+
+        assert self.engine is not None
+        async with self.engine.connect() as conn:
+            result = await conn.execute(catalog.version_query)
+            generation, last_modified = catalog.version_of(result.first())
+            etag = f"catalog-{generation}"
+            if is_resource_modified(environ, etag=etag, last_modified=last_modified):
+                snapshot = await self._get_snapshot(conn, generation)
+                body = _get_images(snapshot, args)
+                resp = Response(body, mimetype="application/json")
+            else:
+                resp = Response("", 304)
+        return _set_cache_headers(resp, etag, last_modified)
+
+    async def _get_snapshot(
+        self, conn: AsyncConnection, generation: int
+    ) -> catalog.Snapshot:
+        """The snapshot of the generation, rebuilt once if outdated."""
+        if self.snapshot is None or self.snapshot.generation != generation:
+            async with self._snapshot_lock:
+                if self.snapshot is None or self.snapshot.generation != generation:
+                    renditions, images, site = catalog.snapshot_queries()
+                    rendition_rows = (await conn.execute(renditions)).all()
+                    image_rows = (await conn.execute(images)).all()
+                    site_row = (await conn.execute(site)).first()
+                    # encoded off the event loop, which keeps serving meanwhile
+                    self.snapshot = await asyncio.to_thread(
+                        catalog.assemble_snapshot,
+                        generation,
+                        rendition_rows,
+                        image_rows,
+                        site_row,
+                    )
+        return self.snapshot
+
+
+app = Retriever()
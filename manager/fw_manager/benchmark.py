@@ -0,0 +1,253 @@
+"""Benchmarks of the ingest pipeline and the query layer.
+
+Queries are measured against a synthetic library seeded into the configured
+database, so point `FLASK_SQLALCHEMY_DATABASE_URI` to a scratch one, and name
+it by `--database` as the commands require. Seeded rows are told apart by their
+URIs, and removed by `clear`. Results are plain data, dumped as JSON by the
+`benchmark` command to compare between releases.
+"""
+
+import math
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+import blurhash
+import sqlalchemy as sa
+from flask import current_app
+from PIL import Image as PImage
+
+from . import duplicates, imaging, search
+from .blueprints.manager import images_page
+from .blueprints.retriever import _encode_cursor, get_images
+from .catalog import cursor_ts
+from .models import db, Image, ImageStatus, Site
+
+SEED_URI_PREFIX = "static/img/benchmark/"
+IMAGE_SIZES = [(640, 480), (1920, 1080), (4000, 3000)]
+IMAGE_FORMATS = ["jpeg", "png"]
+QUERY_ROWS = [1_000, 10_000, 100_000]
+KEYWORDS = ["", "sunset", "rain city"]
+
+_WORDS = (
+    "sunset sunrise rain snow cloud city river mountain street harbor bridge "
+    "forest garden station autumn winter spring summer morning evening night"
+).split()
+
+
+def _measure(fn: Callable, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "repeat": repeat,
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(timings[math.ceil(len(timings) * 0.95) - 1], 3),
+        "min_ms": round(timings[0], 3),
+    }
+
+
+def seeded_count() -> int:
+    return db.session.scalar(
+        db.select(sa.func.count(Image.id)).filter(Image.uri.startswith(SEED_URI_PREFIX))
+    )
+
+
+def seed(count: int, batch_size: int = 5000) -> int:
+    """Insert synthetic images until `count` of them are seeded, files are not
+    written. Returns the count inserted.
+    """
+    start = seeded_count()
+    rng = random.Random(start)
+    for offset in range(start, count, batch_size):
+        rows = []
+        for i in range(offset, min(offset + batch_size, count)):
+            words = rng.choices(_WORDS, k=12)
+            phash = f"{rng.getrandbits(64):016x}"
+            rows.append(
+                {
+                    "uri": f"{SEED_URI_PREFIX}{i:07d}.jpg",
+                    "thumbnail_uri": f"{SEED_URI_PREFIX}thumbnail/{i:07d}.jpg",
+                    "title": f"Benchmark {i:07d} {words[0]}",
+                    "position": words[1],
+                    "time": str(2000 + i % 25),
+                    "description": " ".join(words[2:]),
+                    "blurhash": "LEHV6nWB2yk8pyo0adR*.7kCMdnj",
+                    "width": 4000,
+                    "height": 3000,
+                    "status": ImageStatus.READY,
+                    "phash": phash,
+                }
+                | {f"phash_{i}": band for i, band in enumerate(duplicates.bands(phash))}
+            )
+        # bulk inserted, bypassing the per-row events
+        db.session.execute(sa.insert(Image), rows)
+        db.session.commit()
+    _after_bulk_write()
+    return max(count - start, 0)
+
+
+def clear() -> int:
+    """Delete the seeded images."""
+    result = db.session.execute(
+        sa.delete(Image).filter(Image.uri.startswith(SEED_URI_PREFIX))
+    )
+    db.session.commit()
+    _after_bulk_write()
+    return result.rowcount
+
+
+def _after_bulk_write() -> None:
+    with db.engine.begin() as conn:
+        if search.has_index(conn):
+            search.rebuild_index(conn)
+    site = db.session.scalar(db.select(Site))
+    if site is not None:
+        site.generation = Site.generation + 1
+        db.session.commit()
+
+
+def _sample_image(size: tuple[int, int]) -> PImage.Image:
+    # smooth with some noise, which compresses like a photo more than a fill
+    gradient = PImage.linear_gradient("L").resize(size)
+    noise = PImage.effect_noise(size, 32)
+    return PImage.merge("RGB", [gradient, noise, gradient.rotate(90)])
+
+
+def bench_imaging(sizes=IMAGE_SIZES, formats=IMAGE_FORMATS, repeat=5) -> list[dict]:
+    """Time each phase of deriving an image, by size and format."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        folder = Path(tmp_dir)
+        for w, h in sizes:
+            src_img = _sample_image((w, h))
+            for fmt in formats:
+                suffix = "jpg" if fmt == "jpeg" else fmt
+                img_path = folder / f"{w}x{h}.{suffix}"
+                src_img.save(img_path, fmt)
+                thumbnail_path = folder / f"thumbnail.{suffix}"
+
+                def _thumbnail():
+                    with imaging._open(img_path) as pil_img:
+                        imaging.gen_thumbnail(pil_img)
+
+                with imaging._open(img_path) as pil_img:
+                    thumbnail, _ = imaging.gen_thumbnail(pil_img)
+                    thumbnail.load()
+                sample = thumbnail.copy()
+                sample.thumbnail(
+                    (imaging.BLURHASH_SAMPLE_WIDTH, imaging.BLURHASH_SAMPLE_WIDTH)
+                )
+
+                params = {
+                    "width": w,
+                    "height": h,
+                    "format": fmt,
+                    "bytes": img_path.stat().st_size,
+                }
+                phases = {
+                    "thumbnail": _thumbnail,
+                    "blurhash": lambda: blurhash.encode(sample.copy(), 4, 4),
+                    "save": lambda: thumbnail.save(thumbnail_path),
+                    "derive": lambda: imaging.derive(
+                        img_path,
+                        thumbnail_path,
+                        folder / "rendition",
+                        reencode_original=False,
+                    ),
+                }
+                for phase, fn in phases.items():
+                    results.append(
+                        {"name": f"imaging.{phase}", "params": params}
+                        | _measure(fn, repeat)
+                    )
+    return results
+
+
+def _call_view(view: Callable, path: str, query: dict) -> None:
+    with current_app.test_request_context(path, query_string=query):
+        resp = current_app.make_response(view())
+        resp.get_data()
+
+
+def _cursor_at(offset: int) -> str:
+    """Cursor of the page starting at an offset, as the retriever makes it."""
+    if offset == 0:
+        return ""
+    row = db.session.execute(
+        db.select(cursor_ts, Image.id)
+        .filter_by(status=ImageStatus.READY)
+        .order_by(Image.created_at, Image.id)
+        .offset(offset - 1)
+        .limit(1)
+    ).first()
+    return _encode_cursor(row.cursor_ts, row.id)
+
+
+def bench_queries(rows=QUERY_ROWS, keywords=KEYWORDS, repeat=5) -> list[dict]:
+    """Time the retriever and the manager page at each count of rows, on the
+    first, a middle and the last page, and the lookup of near duplicates.
+    """
+    # the auth of the manager page is not a part of the measure
+    manager_view = images_page.__wrapped__
+    results = []
+    for count in rows:
+        seed(count)
+        total = db.session.scalar(db.select(sa.func.count(Image.id)))
+        phash = f"{random.Random(total).getrandbits(64):016x}"
+        results.append(
+            {"name": "duplicates.find_near", "params": {"rows": total}}
+            | _measure(lambda: duplicates.find_near(phash), repeat)
+        )
+        page_size = 10
+        last_page = max(math.ceil(total / page_size), 1)
+        pages = sorted({1, max(last_page // 2, 1), last_page})
+        for page in pages:
+            params = {"rows": total, "page": page, "page_size": page_size}
+            query = {"page": page, "page_size": page_size}
+            results.append(
+                {"name": "get_images", "params": params}
+                | _measure(lambda: _call_view(get_images, "/images", query), repeat)
+            )
+            for keyword in keywords:
+                kw_query = query | {"keyword": keyword}
+                results.append(
+                    {"name": "images_page", "params": params | {"keyword": keyword}}
+                    | _measure(
+                        lambda: _call_view(manager_view, "/manager", kw_query), repeat
+                    )
+                )
+
+            # the same page by cursor, for comparison with the offset
+            cursor = _cursor_at((page - 1) * page_size)
+            query = {"after": cursor, "page_size": page_size}
+            results.append(
+                {"name": "get_images.cursor", "params": params}
+                | _measure(lambda: _call_view(get_images, "/images", query), repeat)
+            )
+    return results
+
+
+def environment() -> dict:
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "pillow": PImage.__version__,
+        "sqlite": sqlite3.sqlite_version,
+        "database": db.engine.dialect.name,
+        "derivation": imaging.derivation_version(),
+    }
@@ -29,3 +29,11 @@ def not_found(err):
 def internal_server_error(err):
     logger.error(f"An error occurred: {err!r}")
     return make_resp(err_code="INTERNAL_ERROR", msg="An error occurred"), 500
+
+
+@error_bp.app_errorhandler(503)
+def service_unavailable(err):
+    logger.error(f"Service unavailable: {err!r}")
+    resp = make_resp(err_code="SERVICE_BUSY", msg="Service is busy, try again later")
+    retry_after = getattr(err, "retry_after", None) or 1
+    return resp, 503, {"Retry-After": str(retry_after)}
@@ -1,46 +1,112 @@
+import hashlib
+import json
 import os.path
+import tarfile
+import time
+import zipfile
 from pathlib import Path
-from uuid import uuid4
-
-import blurhash
-from flask import render_template, request, redirect, url_for, g, Blueprint, current_app
+from typing import IO, Iterator
+
+from flask import (
+    abort,
+    render_template,
+    request,
+    redirect,
+    url_for,
+    g,
+    session,
+    Blueprint,
+)
 from flask_httpauth import HTTPBasicAuth
 from loguru import logger
-from PIL import Image as PImage
-from sqlalchemy import or_
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import NotFound
 from werkzeug.security import check_password_hash
 
-from ..utils import make_resp
-from ..models import User, Image, Site, db
-from ..forms import UploadImageForm, EditImageForm, SettingsForm
+from .. import (
+    admission,
+    duplicates,
+    imaging,
+    ingest,
+    metrics,
+    search,
+    storage,
+    uploads,
+)
+from ..database import retry_on_locked
+from ..utils import as_bool, make_resp
+from ..models import User, Image, ImageStatus, Site, db
+from ..forms import TITLE_MAX_LENGTH, UploadImageForm, EditImageForm, SettingsForm
 
-IMG_FOLDER = os.environ.get("IMG_FOLDER_NAME", "img")
-THUMBNAIL_FOLDER = os.environ.get("THUMBNAIL_FOLDER_NAME", "thumbnail")
-THUMBNAIL_MAX_WIDTH = int(os.environ.get("THUMBNAIL_MAX_WIDTH", 600))
 DEFAULT_NO_IMAGE_TIP = os.environ.get("DEFAULT_NO_IMAGE_TIP", "No image.")
+AUTH_SESSION_TTL = int(os.environ.get("AUTH_SESSION_TTL", 3600))
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+MANIFEST_NAME = "manifest.json"
+# limits of the files in an archive, checked before they are extracted
+ARCHIVE_MAX_MEMBERS = int(os.environ.get("ARCHIVE_MAX_MEMBERS", 10000))
+ARCHIVE_MAX_SIZE = int(os.environ.get("ARCHIVE_MAX_SIZE", 4 * 1024 * 1024 * 1024))
+EDITABLE_FIELDS = ("title", "position", "time", "description")
+UPLOAD_FIELDS = (*EDITABLE_FIELDS, "filename", "allow_near_duplicate")
+
+MESSAGES = {
+    "": "Success",
+    "REPEAT_TITLE": "Image with same title exists.",
+    "REPEAT_IMAGE": "Same image exists.",
+    "NEAR_DUPLICATE": "Similar image exists.",
+    "INVALID_IMAGE": "Not a valid image.",
+    "IMAGE_TOO_LARGE": "Image is too large.",
+    "OFFSET_MISMATCH": "Chunk is not at the offset received so far.",
+    "INCOMPLETE_UPLOAD": "Upload is not complete.",
+    "INVALID_MANIFEST": "Manifest is not a list of image info.",
+    "ARCHIVE_TOO_LARGE": "Archive has too many files or is too large.",
+}
 
 
 manager_bp = Blueprint("manager", __name__)
 auth = HTTPBasicAuth()
 
 
+def _password_fingerprint(user: User) -> str:
+    # changes along with the password, which revokes the issued sessions
+    return hashlib.sha256(user.password_hash.encode()).hexdigest()[:16]
+
+
+def _session_user(username: str) -> User | None:
+    """The user logged in by the signed session cookie, if still valid."""
+    auth_session = session.get("auth")
+    if not auth_session or auth_session["expires_at"] < time.time():
+        return None
+    user = db.session.get(User, auth_session["user_id"])
+    if not user or (username and username != user.username):
+        return None
+    if auth_session["fingerprint"] != _password_fingerprint(user):
+        return None
+    return user
+
+
 @auth.verify_password
 def verify_password(username, password):
+    # hashing the password is slow by design, so it is only checked once per
+    # session, with Basic auth still working for clients without cookies
+    user = _session_user(username)
+    if user:
+        g.current_user = user
+        return True
+
     user = User.query.filter_by(username=username).first()
     if not user:
         return False
     g.current_user = user
-    return check_password_hash(user.password_hash, password)
-
-
-def _gen_thumbnail(src_img: PImage.Image) -> tuple[PImage.Image, str]:
-    img = src_img.copy()
-    w, h = img.size
-    img.thumbnail((THUMBNAIL_MAX_WIDTH, round(THUMBNAIL_MAX_WIDTH / w * h)))
-    img_hash = blurhash.encode(
-        img.copy(), 4, 4
-    )  # `blurhash.encode` will close the img passed in
-    return img, img_hash
+    if not check_password_hash(user.password_hash, password):
+        return False
+    session["auth"] = {
+        "user_id": user.id,
+        "fingerprint": _password_fingerprint(user),
+        "expires_at": time.time() + AUTH_SESSION_TTL,
+    }
+    return True
 
 
 @manager_bp.get("")
@@ -50,21 +116,12 @@ def images_page():
     page = request.args.get("page", 1, type=int)
     page_size = request.args.get("page_size", 10, type=int)
     keyword = request.args.get("keyword", "")
-    pagination = (
-        Image.query.filter(
-            or_(
-                Image.title.contains(keyword),
-                Image.description.contains(keyword),
-                Image.position.contains(keyword),
-                Image.time.contains(keyword),
-            )
-        )
-        .order_by(Image.updated_at.desc())
-        .paginate(page=page, per_page=page_size, error_out=False)
+    pagination = search.filter_by_keyword(Image.query, keyword).paginate(
+        page=page, per_page=page_size, error_out=False
     )
     if page > pagination.pages > 0:
         return redirect(
-            url_for("get_images", page=1, page_size=page_size, keyword=keyword)
+            url_for(".images_page", page=1, page_size=page_size, keyword=keyword)
         )
     return render_template(
         "manager.html",
@@ -76,6 +133,7 @@ def images_page():
 
 @manager_bp.route("/settings", methods=["GET", "POST"])
 @auth.login_required
+@retry_on_locked
 def settings_page():
     form = SettingsForm()
     site = Site.query.first()
@@ -92,67 +150,547 @@ def settings_page():
     return render_template("settings.html", form=form)
 
 
+class ArchiveTooLargeError(Exception):
+    """An archive goes beyond `ARCHIVE_MAX_MEMBERS` or `ARCHIVE_MAX_SIZE`."""
+
+
+class InvalidManifestError(Exception):
+    """A manifest is not a list of image info."""
+
+
+def _iter_archive(archive) -> Iterator[tuple[str, IO[bytes]]]:
+    """Yield name and content of each file in a zip/tar archive.
+
+    Sizes are checked as the archive declares them, before any file is
+    extracted, so a small archive never expands to fill the disk.
+    """
+    if archive.filename.lower().endswith(".zip"):
+        with zipfile.ZipFile(archive.stream) as zf:
+            zip_infos = [i for i in zf.infolist() if not i.is_dir()]
+            if len(zip_infos) > ARCHIVE_MAX_MEMBERS or (
+                sum(i.file_size for i in zip_infos) > ARCHIVE_MAX_SIZE
+            ):
+                raise ArchiveTooLargeError(archive.filename)
+            for zip_info in zip_infos:
+                with zf.open(zip_info) as member:
+                    yield zip_info.filename, member
+    else:
+        with tarfile.open(fileobj=archive.stream, mode="r:*") as tf:
+            count = size = 0
+            for tar_info in tf:
+                if not tar_info.isfile():
+                    continue
+                count += 1
+                size += tar_info.size
+                if count > ARCHIVE_MAX_MEMBERS or size > ARCHIVE_MAX_SIZE:
+                    raise ArchiveTooLargeError(archive.filename)
+                tar_member = tf.extractfile(tar_info)
+                if tar_member is not None:
+                    yield tar_info.name, tar_member
+
+
+def _parse_manifest(data) -> list[dict]:
+    """Image info of a manifest, as JSON text or a file."""
+    try:
+        manifest = json.loads(data) if isinstance(data, str) else json.load(data)
+    except ValueError as err:
+        raise InvalidManifestError(err) from err
+    if not isinstance(manifest, list) or not all(
+        isinstance(info, dict)
+        and isinstance(info.get("file"), str)
+        and all(isinstance(info.get(k), str | None) for k in EDITABLE_FIELDS)
+        for info in manifest
+    ):
+        raise InvalidManifestError(manifest)
+    return manifest
+
+
+def _invalid_image_resp(err: imaging.InvalidImageError) -> dict:
+    logger.error(f"Invalid image: {err!r}")
+    if isinstance(err, imaging.ImageTooLargeError):
+        return make_resp(err_code="IMAGE_TOO_LARGE", msg="Image is too large.")
+    return make_resp(err_code="INVALID_IMAGE", msg="Not a valid image.")
+
+
+def _repeat_code(err: IntegrityError) -> str:
+    """Error code of the unique constraint violated, of the title or the image."""
+    return "REPEAT_TITLE" if "title" in str(err.orig) else "REPEAT_IMAGE"
+
+
+@retry_on_locked
+def _commit_new_image(img: Image) -> str:
+    """Insert an image, which loses if the same one or the same title is
+    inserted concurrently. Returns the error code if so.
+
+    Files of the same image are left as they are, since they belong to the
+    winner.
+    """
+    uris = [img.uri, img.thumbnail_uri, *(r.uri for r in img.renditions)]
+    db.session.add(img)
+    try:
+        db.session.commit()
+    except IntegrityError as err:
+        db.session.rollback()
+        _delete_unreferenced_files(img.content_hash, uris)
+        return _repeat_code(err)
+    return ""
+
+
+def _delete_unreferenced_files(content_hash: str | None, uris: list[str]) -> None:
+    """Delete files of a deleted image, unless other images still refer to them."""
+    if content_hash:
+        refs = db.session.scalar(
+            db.select(func.count(Image.id)).filter_by(content_hash=content_hash)
+        )
+        if refs:
+            return
+    store = storage.get_storage()
+    for uri in uris:
+        store.delete(storage.key_of(uri))
+
+
 @manager_bp.post("/images")
 @auth.login_required
 def add_image():
     """Add one image."""
-    img_folder = Path(current_app.static_folder) / IMG_FOLDER
-    thumbnail_folder = img_folder / THUMBNAIL_FOLDER
-    thumbnail_folder.mkdir(exist_ok=True, parents=True)
-
     form_data = request.form
 
-    # check repetition
+    # check repetition early, which is enforced by the unique index on commit
     img_exist = db.session.scalar(db.select(Image).filter_by(title=form_data["title"]))
     if img_exist:
-        return make_resp(err_code="REPEAT_TITLE", msg="Image with same title exists.")
+        return make_resp(err_code="REPEAT_TITLE", msg=MESSAGES["REPEAT_TITLE"])
 
-    # save image/thumbnail
+    # stage image, which is short-circuited if the same one exists
     [(_, img_file)] = request.files.items()
 
-    img_name = f"{uuid4().hex}_{img_file.filename}"
-    img_uri = img_folder / img_name
-    pil_img = PImage.open(img_file)
-
-    logger.info("Generating thumbnail...")
-    thumbnail_uri = thumbnail_folder / img_name
-    thumbnail, img_hash = _gen_thumbnail(pil_img)
-    logger.info("Done.")
-
     logger.info("Saving file...")
-    if (
-        any([img_uri.name.lower().endswith(suffix) for suffix in ["jpg", "jpeg"]])
-        and pil_img.mode == "RGBA"
-    ):
-        pil_img = pil_img.convert("RGB")
-        thumbnail = thumbnail.convert("RGB")
-    thumbnail.save(thumbnail_uri)
-    pil_img.save(img_uri)
+    with metrics.span("stage"):
+        staged, content_hash = storage.stage(img_file.stream)
     logger.info("Done.")
+    return _add_staged(form_data, staged, content_hash, img_file.filename)
 
-    # commit db record
-    logger.info("Saving to db...")
-    w, h = pil_img.size
+
+def _add_staged(form_data, staged: Path, content_hash: str, filename: str):
+    """Add one image from a staged file, of a single or a chunked upload."""
+    try:
+        return _add_staged_image(form_data, staged, content_hash, filename)
+    finally:
+        # moved into the work folder if the image is taken, deleted otherwise
+        staged.unlink(missing_ok=True)
+
+
+def _add_staged_image(form_data, staged: Path, content_hash: str, filename: str):
+    metrics.inc("fw_image_bytes_total", staged.stat().st_size)
+    img_exist = db.session.scalar(db.select(Image).filter_by(content_hash=content_hash))
+    if img_exist:
+        return make_resp(
+            img_exist.id, err_code="REPEAT_IMAGE", msg=MESSAGES["REPEAT_IMAGE"]
+        )
+
+    try:
+        with metrics.span("probe"):
+            width, height = imaging.probe(staged)
+    except imaging.InvalidImageError as err:
+        return _invalid_image_resp(err)
+    # near duplicates, e.g. resized or recompressed, unless told to allow them,
+    # by the perceptual hash derived along with the thumbnail
+    check_near = not form_data.get("allow_near_duplicate", False, type=as_bool)
+
+    # originals are kept byte for byte, only read again for derivatives
+    store = storage.get_storage()
+    img_name = storage.content_name(content_hash, filename)
+    img_key = storage.img_key(img_name)
     img = Image(
-        uri=img_uri.relative_to(current_app.root_path).as_posix(),
-        thumbnail_uri=thumbnail_uri.relative_to(current_app.root_path).as_posix(),
+        uri=storage.uri_of(img_key),
+        thumbnail_uri=storage.uri_of(
+            storage.thumbnail_key(img_name, imaging.derivation_version())
+        ),
         title=form_data["title"],
         position=form_data["position"],
         time=form_data["time"],
         description=form_data["description"],
-        blurhash=img_hash,
-        width=w,
-        height=h,
+        content_hash=content_hash,
     )
-    db.session.add(img)
-    db.session.commit()
+    with storage.work_folder() as folder:
+        img_path = folder / img_name
+        staged.replace(img_path)
+
+        if ingest.INGEST_ASYNC:
+            # derivatives are generated in background
+            store.put(img_key, img_path)
+            img.blurhash = ""
+            img.width = img.height = 0
+            img.status = ImageStatus.PENDING
+            err_code = _commit_new_image(img)
+            if err_code:
+                return make_resp(err_code=err_code, msg=MESSAGES[err_code])
+            ingest.submit(img.id, check_near)
+            logger.info(f"Queued image {img.id}.")
+            return make_resp(img.id), 202
+
+        logger.info("Generating thumbnail...")
+        try:
+            # decodes are admitted by their pixels, which may answer 503
+            with admission.admit(width * height), metrics.span("derive"):
+                meta = imaging.derive(*ingest.derive_args(img_path, folder))
+        except imaging.InvalidImageError as err:
+            return _invalid_image_resp(err)
+        logger.info("Done.")
+        near = duplicates.find_near(meta["phash"]) if check_near else []
+        if near:
+            return make_resp(
+                near[0][0], err_code="NEAR_DUPLICATE", msg=MESSAGES["NEAR_DUPLICATE"]
+            )
+
+        logger.info("Storing files...")
+        with metrics.span("store"):
+            meta = ingest.store_derived(img_name, folder, meta)
+            store.put(img_key, img_path)
+        logger.info("Done.")
+
+    # commit db record
+    logger.info("Saving to db...")
+    ingest.apply_derived(img, meta)
+    with metrics.span("commit"):
+        err_code = _commit_new_image(img)
+    if err_code:
+        return make_resp(err_code=err_code, msg=MESSAGES[err_code])
 
     logger.info("Done.")
     return make_resp(img.id), 201
 
 
+@manager_bp.post("/uploads")
+@auth.login_required
+def create_upload():
+    """Open a resumable upload of one image, of the fields `add_image` takes
+    along with the `filename` and the `size` in bytes of the image.
+    """
+    form_data = request.form
+    size = form_data.get("size", type=int)
+    if not form_data.get("title") or not form_data.get("filename") or size is None:
+        abort(400)
+    if not 0 < size <= uploads.UPLOAD_MAX_SIZE:
+        return make_resp(err_code="IMAGE_TOO_LARGE", msg=MESSAGES["IMAGE_TOO_LARGE"])
+    img_exist = db.session.scalar(db.select(Image).filter_by(title=form_data["title"]))
+    if img_exist:
+        return make_resp(err_code="REPEAT_TITLE", msg=MESSAGES["REPEAT_TITLE"])
+
+    fields = {k: form_data.get(k, "") for k in UPLOAD_FIELDS}
+    upload_id = uploads.create(fields, size)
+    logger.info(f"Opened upload {upload_id} of {size} bytes.")
+    return make_resp({"id": upload_id, "offset": 0, "size": size}), 201
+
+
+def _get_upload(upload_id: str) -> dict:
+    upload = uploads.get(upload_id)
+    if upload is None:
+        raise NotFound()
+    return upload
+
+
+@manager_bp.get("/uploads/<upload_id>")
+@auth.login_required
+def get_upload(upload_id):
+    """Offset to resume an upload from, i.e. the bytes received so far."""
+    upload = _get_upload(upload_id)
+    return make_resp(
+        {"id": upload_id, "offset": upload["offset"], "size": upload["size"]}
+    )
+
+
+@manager_bp.put("/uploads/<upload_id>")
+@auth.login_required
+def put_upload_chunk(upload_id):
+    """Append the request body at `offset`, which must be the bytes received
+    so far, otherwise they are answered as OFFSET_MISMATCH.
+    """
+    _get_upload(upload_id)
+    offset = request.args.get("offset", type=int)
+    if offset is None:
+        abort(400)
+    try:
+        with metrics.span("stage"):
+            offset = uploads.append(upload_id, offset, request.stream)
+    except uploads.OffsetMismatchError as err:
+        return make_resp(
+            err.args[0], err_code="OFFSET_MISMATCH", msg=MESSAGES["OFFSET_MISMATCH"]
+        )
+    except uploads.UploadTooLargeError:
+        return make_resp(err_code="IMAGE_TOO_LARGE", msg=MESSAGES["IMAGE_TOO_LARGE"])
+    return make_resp({"id": upload_id, "offset": offset})
+
+
+@manager_bp.post("/uploads/<upload_id>/finalize")
+@auth.login_required
+def finalize_upload(upload_id):
+    """Add the image of a complete upload, just as `add_image` does."""
+    upload = _get_upload(upload_id)
+    if upload["offset"] != upload["size"]:
+        return make_resp(
+            upload["offset"],
+            err_code="INCOMPLETE_UPLOAD",
+            msg=MESSAGES["INCOMPLETE_UPLOAD"],
+        )
+    logger.info(f"Finalizing upload {upload_id}...")
+    with metrics.span("stage"):
+        staged, content_hash = uploads.finish(upload_id)
+    logger.info("Done.")
+    # kept if this raises, e.g. 503, so that finalizing is retried
+    resp = _add_staged(MultiDict(upload), staged, content_hash, upload["filename"])
+    uploads.delete(upload_id)
+    return resp
+
+
+@manager_bp.delete("/uploads/<upload_id>")
+@auth.login_required
+def delete_upload(upload_id):
+    """Abort an upload, the bytes received are deleted."""
+    _get_upload(upload_id)
+    uploads.delete(upload_id)
+    return make_resp(upload_id)
+
+
+@manager_bp.post("/images/bulk")
+@auth.login_required
+def add_images():
+    """Add images in bulk, from many files and/or zip/tar archives.
+
+    Info of images goes in a `manifest.json` in the archive or a `manifest`
+    field, as a list of `{"file", "title", "position", "time", "description"}`,
+    titles default to file names. Results are reported per file.
+    """
+    with storage.work_folder() as folder:
+        try:
+            manifest = _parse_manifest(request.form.get("manifest") or "[]")
+            items = _save_bulk_files(folder, manifest)
+        except InvalidManifestError:
+            return make_resp(
+                err_code="INVALID_MANIFEST", msg=MESSAGES["INVALID_MANIFEST"]
+            ), 400
+        except ArchiveTooLargeError as err:
+            logger.error(f"Archive too large: {err!r}")
+            return make_resp(
+                err_code="ARCHIVE_TOO_LARGE", msg=MESSAGES["ARCHIVE_TOO_LARGE"]
+            ), 413
+        _check_bulk_repetition(items, manifest)
+        _derive_bulk(folder, items)
+        if not request.form.get("allow_near_duplicate", False, type=as_bool):
+            _check_bulk_near_duplicates(items)
+
+        logger.info("Storing files...")
+        store = storage.get_storage()
+        with metrics.span("store"):
+            for item in items:
+                if "image" not in item:
+                    continue
+                ingest.apply_derived(
+                    item["image"],
+                    ingest.store_derived(item["name"], folder, item["meta"]),
+                )
+                if (folder / item["name"]).exists():
+                    store.put(storage.img_key(item["name"]), folder / item["name"])
+        logger.info("Done.")
+    # files of rejected items go along with the work folder
+
+    logger.info("Saving to db...")
+    with metrics.span("commit"):
+        _commit_images([item for item in items if "image" in item])
+    logger.info("Done.")
+
+    for item in items:
+        metrics.inc("fw_bulk_items_total", err_code=item["err_code"])
+    results = [
+        {
+            "file": item["file"],
+            "id": item["image"].id if "image" in item else None,
+            "err_code": item["err_code"],
+            "msg": MESSAGES[item["err_code"]],
+        }
+        for item in items
+    ]
+    created = any(r["id"] for r in results)
+    return make_resp(results), 201 if created else 200
+
+
+@retry_on_locked
+def _commit_images(items: list[dict]) -> None:
+    db.session.add_all(item["image"] for item in items)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        # some titles or images were taken concurrently, so commit one by one
+        for item in items:
+            item["err_code"] = _commit_new_image(item["image"])
+            if item["err_code"]:
+                del item["image"]
+
+
+def _save_bulk_files(folder: Path, manifest: list[dict]) -> list[dict]:
+    """Save uploaded files into a work folder as is, named by their content."""
+    items = []
+
+    def _save(filename: str, src: IO[bytes]) -> None:
+        with metrics.span("stage"):
+            staged, content_hash = storage.stage(src)
+        metrics.inc("fw_image_bytes_total", staged.stat().st_size)
+        img_name = storage.content_name(content_hash, filename)
+        if (folder / img_name).exists():
+            staged.unlink()
+        else:
+            staged.replace(folder / img_name)
+        items.append(
+            {
+                "file": filename,
+                "content_hash": content_hash,
+                "name": img_name,
+                "err_code": "",
+            }
+        )
+
+    logger.info("Saving files...")
+    for _, upload in request.files.items(multi=True):
+        upload_name = upload.filename or ""
+        if not upload_name.lower().endswith(ARCHIVE_SUFFIXES):
+            _save(Path(upload_name).name, upload.stream)
+            continue
+        for member_name, member in _iter_archive(upload):
+            filename = Path(member_name).name
+            if filename == MANIFEST_NAME:
+                manifest.extend(_parse_manifest(member))
+            elif not filename.startswith(".") and "__MACOSX" not in member_name:
+                _save(filename, member)
+    logger.info(f"Done, {len(items)} file(s) saved.")
+    return items
+
+
+def _check_bulk_repetition(items: list[dict], manifest: list[dict]) -> None:
+    """Check repetition, against existing images and in the batch."""
+    infos = {info["file"]: info for info in manifest}
+    for item in items:
+        item["info"] = infos.get(item["file"], {})
+        item["title"] = item["info"].get("title") or Path(item["file"]).stem
+    titles = set(
+        db.session.scalars(
+            db.select(Image.title).filter(Image.title.in_(i["title"] for i in items))
+        )
+    )
+    hashes = set(
+        db.session.scalars(
+            db.select(Image.content_hash).filter(
+                Image.content_hash.in_(i["content_hash"] for i in items)
+            )
+        )
+    )
+    for item in items:
+        if item["content_hash"] in hashes:
+            item["err_code"] = "REPEAT_IMAGE"
+        elif item["title"] in titles:
+            item["err_code"] = "REPEAT_TITLE"
+        else:
+            titles.add(item["title"])
+            hashes.add(item["content_hash"])
+
+
+def _derive_bulk(folder: Path, items: list[dict]) -> None:
+    logger.info("Generating thumbnails...")
+    todo = [item for item in items if not item["err_code"]]
+    with metrics.span("derive"):
+        derived = ingest.derive_many(
+            [ingest.derive_args(folder / i["name"], folder) for i in todo]
+        )
+    for item, meta in zip(todo, derived):
+        if isinstance(meta, Exception):
+            logger.error(f"Failed to process {item['file']}: {meta!r}")
+            if isinstance(meta, imaging.ImageTooLargeError):
+                item["err_code"] = "IMAGE_TOO_LARGE"
+            else:
+                item["err_code"] = "INVALID_IMAGE"
+            continue
+        item["meta"] = meta
+        item["image"] = Image(
+            uri=storage.uri_of(storage.img_key(item["name"])),
+            thumbnail_uri=storage.uri_of(
+                storage.thumbnail_key(item["name"], item["meta"]["derivation"])
+            ),
+            title=item["title"],
+            position=item["info"].get("position", ""),
+            time=item["info"].get("time", ""),
+            description=item["info"].get("description", ""),
+            content_hash=item["content_hash"],
+        )
+    logger.info("Done.")
+
+
+def _check_bulk_near_duplicates(items: list[dict]) -> None:
+    """Check near duplicates, against existing images and in the batch."""
+    accepted: list[str] = []
+    for item in items:
+        if "image" not in item:
+            continue
+        phash = item["meta"]["phash"]
+        if duplicates.find_near(phash) or any(
+            duplicates.distance(phash, other) <= duplicates.NEAR_DUPLICATE_DISTANCE
+            for other in accepted
+        ):
+            item["err_code"] = "NEAR_DUPLICATE"
+            del item["image"]
+        else:
+            accepted.append(phash)
+
+
+@manager_bp.get("/duplicates")
+@auth.login_required
+def get_duplicates():
+    """Groups of near duplicate images, apart by `distance` bits at most."""
+    max_distance = request.args.get(
+        "distance", duplicates.NEAR_DUPLICATE_DISTANCE, type=int
+    )
+    groups = duplicates.clusters(max_distance)
+    ids = [image_id for group in groups for image_id in group]
+    images = {
+        img.id: img
+        for img in db.session.scalars(db.select(Image).filter(Image.id.in_(ids)))
+    }
+    return make_resp(
+        [
+            [
+                {
+                    "id": image_id,
+                    "title": images[image_id].title,
+                    "uri": images[image_id].uri,
+                    "thumbnail_uri": images[image_id].thumbnail_uri,
+                    "width": images[image_id].width,
+                    "height": images[image_id].height,
+                }
+                for image_id in group
+            ]
+            for group in groups
+        ]
+    )
+
+
+@manager_bp.get("/admission")
+@auth.login_required
+def get_admission():
+    """Decode slots in use and uploads waiting for them, across the workers."""
+    return make_resp(admission.state())
+
+
+@manager_bp.get("/images/<image_id>/status")
+@auth.login_required
+def get_image_status(image_id):
+    """Processing status of one certain image, the image id is the job id."""
+    img = db.session.get(Image, image_id)
+    if not img:
+        return make_resp(err_code="INVALID_IMAGE", msg="Target image does not exist.")
+    return make_resp({"id": img.id, "status": img.status})
+
+
 @manager_bp.put("/images/<image_id>")
 @auth.login_required
+@retry_on_locked
 def update_image(image_id):
     """Update info of one certain image."""
     form_data = request.form
@@ -162,40 +700,86 @@ def update_image(image_id):
     if not img:
         return make_resp(err_code="INVALID_IMAGE", msg="Target image does not exist.")
 
-    # check repetition
-    img_repeat = db.session.scalar(
-        db.select(Image)
-        .filter_by(title=form_data["title"])
-        .filter(Image.id.isnot(image_id))
-    )
-    if img_repeat:
-        return make_resp(err_code="REPEAT_TITLE", msg="Image with same title exists.")
-
     img.title = form_data["title"]
     img.position = form_data["position"]
     img.time = form_data["time"]
     img.description = form_data["description"]
 
-    db.session.commit()
+    # repetition is checked by the unique index of titles
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return make_resp(err_code="REPEAT_TITLE", msg=MESSAGES["REPEAT_TITLE"])
     return make_resp()
 
 
+def _is_valid_edit(edit) -> bool:
+    """Whether an item of a batch edit is valid, as by `EditImageForm`."""
+    return (
+        isinstance(edit, dict)
+        and isinstance(edit.get("id"), int)
+        and edit.keys() <= {"id", *EDITABLE_FIELDS}
+        and all(isinstance(edit[f], str) for f in EDITABLE_FIELDS if f in edit)
+        and ("title" not in edit or 1 <= len(edit["title"]) <= TITLE_MAX_LENGTH)
+    )
+
+
+@manager_bp.put("/images")
+@auth.login_required
+@retry_on_locked
+def update_images():
+    """Update info of many images at once, all or none of them.
+
+    Takes a JSON list of `{"id", "title", "position", "time", "description"}`,
+    where fields left out are kept as they are.
+    """
+    edits = request.get_json(silent=True)
+    if not isinstance(edits, list) or not all(map(_is_valid_edit, edits)):
+        abort(400)
+
+    ids = [edit["id"] for edit in edits]
+    images = {
+        img.id: img
+        for img in db.session.scalars(db.select(Image).filter(Image.id.in_(ids)))
+    }
+    missing = [image_id for image_id in ids if image_id not in images]
+    if missing:
+        return make_resp(
+            missing, err_code="INVALID_IMAGE", msg="Target image does not exist."
+        )
+
+    for edit in edits:
+        for field in EDITABLE_FIELDS:
+            if field in edit:
+                setattr(images[edit["id"]], field, edit[field])
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return make_resp(err_code="REPEAT_TITLE", msg=MESSAGES["REPEAT_TITLE"])
+    return make_resp(ids)
+
+
 @manager_bp.delete("/images/<image_id>")
 @auth.login_required
+@retry_on_locked
 def delete_image(image_id):
     """Delete one certain image."""
     img = db.session.get(Image, image_id)
     if not img:
         return make_resp(err_code="INVALID_IMAGE", msg="Target image does not exist.")
 
+    content_hash = img.content_hash
+    uris = [img.uri, img.thumbnail_uri, *(r.uri for r in img.renditions)]
+
     logger.info(f"Deleting db record: {image_id}...")
     db.session.delete(img)
     db.session.commit()
     logger.info("Done.")
 
     logger.info("Deleting file...")
-    root_folder = Path(current_app.root_path)
-    (root_folder / img.uri).unlink(missing_ok=True)
-    (root_folder / img.thumbnail_uri).unlink(missing_ok=True)
+    _delete_unreferenced_files(content_hash, uris)
     logger.info("Done.")
     return "", 204
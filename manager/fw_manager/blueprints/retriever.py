@@ -1,26 +1,235 @@
-from flask import request, Blueprint
+import base64
+import binascii
+import json
+import math
+import os
+import zlib
+from bisect import bisect_right
+from typing import Iterator
 
-from ..models import db, Image, Site
+from flask import (
+    Response,
+    request,
+    Blueprint,
+    abort,
+    make_response,
+    stream_with_context,
+)
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import BadRequest
+from werkzeug.http import is_resource_modified
+from werkzeug.wrappers import Response as BaseResponse
 
+from .. import catalog, imaging
+from ..models import db, Image, ImageStatus
+from ..utils import as_bool
+
+IMAGES_CACHE_MAX_AGE = int(os.environ.get("IMAGES_CACHE_MAX_AGE", 0))
+PLACEHOLDER_CACHE_MAX_AGE = int(os.environ.get("PLACEHOLDER_CACHE_MAX_AGE", 86400))
+# bytes of the manifest compressed at a time
+MANIFEST_CHUNK_SIZE = int(os.environ.get("MANIFEST_CHUNK_SIZE", 64 * 1024))
+# the highest levels take far too long to compress on the fly
+MANIFEST_BROTLI_QUALITY = int(os.environ.get("MANIFEST_BROTLI_QUALITY", 5))
+
+try:
+    import brotli
+except ImportError:  # optional, the manifest is compressed by gzip without it
+    brotli = None
+DEFAULT_PAGE_SIZE = 10
 
 retriever_bp = Blueprint("retriever", __name__)
 
 
+def _encode_cursor(created_at: str, image_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at}|{image_id}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        created_at, image_id = base64.urlsafe_b64decode(cursor).decode().split("|")
+        return created_at, int(image_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as err:
+        raise BadRequest() from err
+
+
+def _parse_fields(args: MultiDict) -> list[int]:
+    """Indexes of the image fields asked by `fields`, all of them by default."""
+    fields = args.get("fields")
+    if not fields:
+        return list(range(len(catalog.IMAGE_FIELDS)))
+    try:
+        return [catalog.IMAGE_FIELDS.index(f.strip()) for f in fields.split(",")]
+    except ValueError as err:
+        raise BadRequest() from err
+
+
+def _get_images_after(
+    snapshot: catalog.Snapshot, args: MultiDict, cursor: str, page_size: int
+) -> tuple[int, int, dict]:
+    """Keyset pagination over (created_at, id)."""
+    start = bisect_right(snapshot.keys, _decode_cursor(cursor)) if cursor else 0
+    end = start + page_size
+    next_cursor = None
+    if end < len(snapshot.keys):
+        next_cursor = _encode_cursor(*snapshot.keys[end - 1])
+
+    extra: dict[str, str | int | None] = {"next": next_cursor}
+    if args.get("with_total", False, type=as_bool):
+        extra["total"] = len(snapshot.keys)
+    return start, end, extra
+
+
+def _set_cache_headers(resp: BaseResponse, etag: str, last_modified) -> BaseResponse:
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    resp.cache_control.public = True
+    resp.cache_control.max_age = IMAGES_CACHE_MAX_AGE
+    resp.cache_control.must_revalidate = True
+    return resp
+
+
 @retriever_bp.get("")
 def get_images():
-    """Fetch images in JSON."""
-    page = request.args.get("page", 1, type=int)
-    page_size = request.args.get("page_size", 10, type=int)
-    pagination = Image.query.order_by(Image.updated_at).paginate(
-        page=page, per_page=page_size, error_out=False
+    """Fetch images in JSON, conditionally by the catalog generation."""
+    generation, last_modified = catalog.current_version()
+    etag = f"catalog-{generation}"
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        resp = make_response(
+            _get_images(catalog.get_snapshot(generation), request.args)
+        )
+        resp.mimetype = "application/json"
+    else:
+        resp = make_response("", 304)
+    return _set_cache_headers(resp, etag, last_modified)
+
+
+def _get_images(snapshot: catalog.Snapshot, args: MultiDict) -> str:
+    """Pass `after` (empty for the first page, then the `next` of the previous
+    response) to paginate by cursor, `with_total=1` to also count images, and
+    `fields`, e.g. `id,title,renditions`, to only get the fields needed.
+
+    Pages are sliced from the catalog snapshot of this process.
+    """
+    fields = _parse_fields(args)
+    page_size = args.get("page_size", DEFAULT_PAGE_SIZE, type=int)
+    if page_size < 1:
+        page_size = DEFAULT_PAGE_SIZE
+    cursor = args.get("after")
+    if cursor is not None:
+        start, end, extra = _get_images_after(snapshot, args, cursor, page_size)
+        return catalog.render_page(snapshot, start, end, fields, extra | snapshot.site)
+
+    page = max(args.get("page", 1, type=int), 1)
+    total = len(snapshot.records)
+    start = (page - 1) * page_size
+    extra = {"pages": math.ceil(total / page_size), "total": total}
+    return catalog.render_page(
+        snapshot, start, start + page_size, fields, extra | snapshot.site
+    )
+
+
+@retriever_bp.get("/<int:image_id>/placeholder")
+def get_placeholder(image_id):
+    """The placeholder of an image as a file, for clients to load by URL
+    rather than inline, conditionally by its blurhash.
+    """
+    row = db.session.execute(
+        db.select(
+            Image.blurhash, Image.placeholder, Image.width, Image.height
+        ).filter_by(id=image_id, status=ImageStatus.READY)
+    ).first()
+    if row is None:
+        abort(404)
+    data_uri = row.placeholder or imaging.placeholder(
+        row.blurhash, row.width, row.height
+    )
+    if not data_uri:
+        abort(404)
+    header, data = data_uri.split(",", 1)
+    resp = make_response(base64.b64decode(data))
+    resp.mimetype = header.removeprefix("data:").split(";")[0]
+    resp.set_etag(row.blurhash)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = PLACEHOLDER_CACHE_MAX_AGE
+    return resp.make_conditional(request)
+
+
+def _manifest_encoding() -> str:
+    """Content encoding of the manifest, brotli or gzip as accepted."""
+    for encoding in ["br", "gzip"]:
+        if encoding == "br" and brotli is None:
+            continue
+        if request.accept_encodings[encoding]:
+            return encoding
+    return "identity"
+
+
+def _compress(chunks: Iterator[str], encoding: str) -> Iterator[bytes]:
+    """Encode text by a content encoding, in batches of `MANIFEST_CHUNK_SIZE`."""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=MANIFEST_BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    elif encoding == "gzip":
+        compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+        compress, finish = compressor.compress, compressor.flush
+    else:
+        compress, finish = bytes, bytes
+
+    batch = []
+    size = 0
+    for chunk in chunks:
+        data = chunk.encode()
+        batch.append(data)
+        size += len(data)
+        if size >= MANIFEST_CHUNK_SIZE:
+            data = compress(b"".join(batch))
+            batch, size = [], 0
+            if data:
+                yield data
+    data = compress(b"".join(batch)) + finish()
+    if data:
+        yield data
+
+
+@retriever_bp.get("/manifest")
+def get_manifest():
+    """Stream the whole catalog as NDJSON, the site settings on the first line,
+    then an image on each line by id, compressed by brotli or gzip if accepted.
+
+    Pass `after_id`, e.g. the id of the last image received, to resume, and
+    `fields` as to `/images`, the id is always there. Rows are streamed from
+    the database, so it takes the same memory for any count of images.
+    """
+    generation, last_modified = catalog.current_version()
+    encoding = _manifest_encoding()
+    # bodies of each encoding differ byte for byte, so do their strong ETags
+    etag = f"catalog-{generation}-{encoding}"
+    if not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
+    ):
+        resp = make_response("", 304)
+        resp.vary.add("Accept-Encoding")
+        return _set_cache_headers(resp, etag, last_modified)
+
+    fields = _parse_fields(request.args)
+    id_index = catalog.IMAGE_FIELDS.index("id")
+    if id_index not in fields:
+        fields.insert(0, id_index)
+    after_id = request.args.get("after_id", 0, type=int)
+    site = catalog.current_site() | {"generation": generation}
+
+    def _lines() -> Iterator[str]:
+        yield json.dumps(site, ensure_ascii=False, separators=(",", ":")) + "\n"
+        for record in catalog.stream_records(fields, after_id):
+            yield record + "\n"
+
+    resp = Response(
+        stream_with_context(_compress(_lines(), encoding)),
+        mimetype="application/x-ndjson",
     )
-    images = [p.as_dict() for p in pagination.items]
-    site = db.session.scalar(db.select(Site))
-    return {
-        "images": images,
-        "pages": pagination.pages,
-        "total": pagination.total,
-        "site_title": site.title,
-        "site_description": site.description,
-        "no_image_tip": site.no_image_tip,
-    }
+    if encoding != "identity":
+        resp.content_encoding = encoding
+    resp.vary.add("Accept-Encoding")
+    # passed on as it goes by nginx, rather than buffered
+    resp.headers["X-Accel-Buffering"] = "no"
+    return _set_cache_headers(resp, etag, last_modified)
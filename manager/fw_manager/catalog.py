@@ -0,0 +1,222 @@
+"""Versioning of the public catalog, i.e. the images and the site settings.
+
+Each process keeps a snapshot of the catalog, which the public gallery is
+served from in memory. It is rebuilt lazily once the generation, bumped by
+every write of any process, moves on.
+"""
+
+import json
+import os
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import chain
+from threading import Lock
+from typing import Iterator
+
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import current_app
+from sqlalchemy import event
+from werkzeug.http import http_date
+
+from . import imaging
+from .models import db, Image, ImageStatus, Rendition, Site
+
+# `created_at` is compared as it is stored, since rows written by `func.now()`
+# and bound datetime params are formatted differently by SQLite
+cursor_ts = sa.type_coerce(Image.created_at, sa.String).label("cursor_ts")
+
+
+# bands of the perceptual hash are only there to be looked up by
+IMAGE_COLUMNS = [c for c in Image.__table__.columns if not c.name.startswith("phash_")]
+IMAGE_FIELDS = [c.name for c in IMAGE_COLUMNS] + ["renditions"]
+RENDITION_FIELDS = ["uri", "width", "height", "format", "size"]
+# rows fetched at a time when streaming the catalog
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 1000))
+
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    generation: int
+    # JSON members `"field":value` of each ready image, in the order of
+    # `IMAGE_FIELDS`, and the images in the order of (created_at, id), which
+    # edits never change, so a cursor never passes over an image twice
+    records: list[tuple[str, ...]]
+    # (created_at as stored, id) of each image, to find pages by cursor
+    keys: list[tuple[str, int]]
+    site: dict
+
+
+_snapshot_lock = Lock()
+
+
+version_query = sa.select(Site.generation, Site.updated_at)
+
+
+def version_of(row) -> tuple[int, datetime | None]:
+    if row is None:
+        return 0, None
+    return row.generation or 0, row.updated_at
+
+
+def current_version() -> tuple[int, datetime | None]:
+    """Returns the catalog generation and when it was last changed."""
+    return version_of(db.session.execute(version_query).first())
+
+
+@event.listens_for(so.Session, "before_flush")
+def _bump_generation(session, flush_context, instances):
+    changed = any(
+        isinstance(obj, (Image, Site)) for obj in chain(session.new, session.deleted)
+    ) or any(
+        isinstance(obj, (Image, Site)) and session.is_modified(obj)
+        for obj in session.dirty
+    )
+    if not changed:
+        return
+    with session.no_autoflush:
+        site = session.scalar(db.select(Site))
+    if site is not None:
+        # incremented in SQL so concurrent writers never lose a bump
+        site.generation = Site.generation + 1
+
+
+def _encode_value(value) -> str:
+    # dates formatted as Flask does, for compatibility with earlier responses
+    if isinstance(value, datetime):
+        return f'"{http_date(value)}"'
+    return _encode(value)
+
+
+def snapshot_queries() -> tuple[sa.Select, sa.Select, sa.Select]:
+    """Selects of the renditions, the images and the site of a snapshot,
+    projecting the columns by Core, so no ORM instance is hydrated."""
+    renditions = (
+        sa.select(
+            Rendition.image_id, *(getattr(Rendition, f) for f in RENDITION_FIELDS)
+        )
+        .join(Image)
+        .filter(Image.status == ImageStatus.READY)
+        .order_by(Rendition.image_id, Rendition.width, Rendition.id)
+    )
+    images = (
+        sa.select(*IMAGE_COLUMNS, cursor_ts)
+        .filter(Image.status == ImageStatus.READY)
+        .order_by(Image.created_at, Image.id)
+    )
+    site = sa.select(Site.title, Site.description, Site.no_image_tip)
+    return renditions, images, site
+
+
+def _encode_record(row, renditions: list[dict], fields: list[int]) -> tuple[str, ...]:
+    """JSON members of the given fields of an image row."""
+    values = [*row[: len(IMAGE_COLUMNS)], renditions]
+    if not row.placeholder:
+        # ingested before placeholders were, until they are regenerated
+        values[IMAGE_FIELDS.index("placeholder")] = imaging.placeholder(
+            row.blurhash, row.width, row.height
+        )
+    return tuple(f'"{IMAGE_FIELDS[i]}":{_encode_value(values[i])}' for i in fields)
+
+
+def _site_of(site_row) -> dict:
+    return {
+        "site_title": site_row.title if site_row else None,
+        "site_description": site_row.description if site_row else None,
+        "no_image_tip": site_row.no_image_tip if site_row else None,
+    }
+
+
+def assemble_snapshot(
+    generation: int, rendition_rows, image_rows, site_row
+) -> Snapshot:
+    """A snapshot from the rows of `snapshot_queries`, however they were run."""
+    renditions = defaultdict(list)
+    for image_id, *values in rendition_rows:
+        renditions[image_id].append(dict(zip(RENDITION_FIELDS, values)))
+
+    fields = list(range(len(IMAGE_FIELDS)))
+    records = []
+    keys = []
+    for row in image_rows:
+        records.append(_encode_record(row, renditions.get(row.id, []), fields))
+        keys.append((row.cursor_ts, row.id))
+
+    return Snapshot(
+        generation=generation, records=records, keys=keys, site=_site_of(site_row)
+    )
+
+
+def current_site() -> dict:
+    _, _, site = snapshot_queries()
+    return _site_of(db.session.execute(site).first())
+
+
+def stream_records(fields: list[int], after_id: int = 0) -> Iterator[str]:
+    """JSON of each ready image after `after_id` by id, of the given fields.
+
+    Images and their renditions are read side by side from two cursors, both
+    in the order of image ids and `STREAM_BATCH_SIZE` rows at a time, so that
+    memory stays the same whatever the count of images.
+    """
+    renditions, images, _ = snapshot_queries()
+    images = images.filter(Image.id > after_id).order_by(None).order_by(Image.id)
+    image_rows = db.session.execute(
+        images.execution_options(yield_per=STREAM_BATCH_SIZE)
+    )
+    rendition_rows: Iterator[sa.Row] = iter(())
+    if IMAGE_FIELDS.index("renditions") in fields:
+        rendition_rows = iter(
+            db.session.execute(
+                renditions.filter(Rendition.image_id > after_id).execution_options(
+                    yield_per=STREAM_BATCH_SIZE
+                )
+            )
+        )
+    rendition = next(rendition_rows, None)
+    for row in image_rows:
+        image_renditions: list[dict] = []
+        while rendition is not None and rendition.image_id <= row.id:
+            if rendition.image_id == row.id:
+                image_renditions.append(dict(zip(RENDITION_FIELDS, rendition[1:])))
+            rendition = next(rendition_rows, None)
+        yield "{" + ",".join(_encode_record(row, image_renditions, fields)) + "}"
+
+
+def _build_snapshot(generation: int) -> Snapshot:
+    renditions, images, site = snapshot_queries()
+    return assemble_snapshot(
+        generation,
+        db.session.execute(renditions),
+        db.session.execute(images),
+        db.session.execute(site).first(),
+    )
+
+
+def render_page(
+    snapshot: Snapshot, start: int, end: int, fields: list[int], extra: dict
+) -> str:
+    """JSON of a page of images, joined from the members of the given fields."""
+    images = ",".join(
+        "{" + ",".join(record[i] for i in fields) + "}"
+        for record in snapshot.records[start:end]
+    )
+    rest = ",".join(f"{_encode(k)}:{_encode_value(v)}" for k, v in extra.items())
+    return '{"images":[' + images + "]" + (f",{rest}" if rest else "") + "}"
+
+
+def get_snapshot(generation: int | None = None) -> Snapshot:
+    """The snapshot of the current generation, rebuilt if outdated."""
+    if generation is None:
+        generation, _ = current_version()
+    snapshot = current_app.extensions.get("fw_catalog_snapshot")
+    if snapshot is None or snapshot.generation != generation:
+        with _snapshot_lock:
+            snapshot = current_app.extensions.get("fw_catalog_snapshot")
+            if snapshot is None or snapshot.generation != generation:
+                snapshot = _build_snapshot(generation)
+                current_app.extensions["fw_catalog_snapshot"] = snapshot
+    return snapshot
@@ -1,8 +1,71 @@
+import json
+from pathlib import Path
+from typing import Sequence
+
 import click
-from flask import Flask
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from flask import Flask, current_app
+from sqlalchemy.schema import CreateColumn
 from werkzeug.security import generate_password_hash
 
-from .models import db, User, Site
+from . import imaging, ingest, search, storage
+from .models import db, Image, ImageStatus, User, Site
+
+REGENERATE_CHECKPOINT = "regenerate.checkpoint"
+
+
+def _repeated_values(conn: sa.Connection, index: sa.Index) -> Sequence[sa.Row]:
+    """Values of the columns of an index taken by more than one row, along with
+    the count of them. NULLs are left out, as unique indexes allow any of them,
+    e.g. of a column added after the rows were."""
+    columns = list(index.columns)
+    return conn.execute(
+        sa.select(*columns, sa.func.count())
+        .filter(*(c.isnot(None) for c in columns))
+        .group_by(*columns)
+        .having(sa.func.count() > 1)
+    ).all()
+
+
+def _upgrade_tables() -> None:
+    """Add columns and indexes introduced after the tables were created.
+
+    A unique index is not created over values repeated already, which are
+    listed to be made unique first.
+    """
+    inspector = sa.inspect(db.engine)
+    skipped: list[str] = []
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            columns = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    click.echo(f"Adding column {table.name}.{column.name}...")
+                    column_ddl = CreateColumn(column).compile(dialect=conn.dialect)
+                    conn.execute(
+                        sa.text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}")
+                    )
+            indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in indexes:
+                    continue
+                repeated = _repeated_values(conn, index) if index.unique else []
+                if repeated:
+                    click.echo(f"Skipping unique index {index.name}, repeated are:")
+                    for *values, count in repeated:
+                        click.echo(f"  {', '.join(map(repr, values))}: {count} rows")
+                    skipped.append(str(index.name))
+                    continue
+                click.echo(f"Creating index {index.name}...")
+                index.create(conn)
+    if skipped:
+        raise click.ClickException(
+            f"Make the values listed unique and run again to create "
+            f"{', '.join(skipped)}."
+        )
 
 
 @click.command(name="create-tables")
@@ -17,6 +80,11 @@ from .models import db, User, Site
 def create_tables(username, password) -> None:
     """Create all tables."""
     db.create_all()
+    _upgrade_tables()
+    with db.engine.begin() as conn:
+        if search.create_index(conn):
+            click.echo("Building search index...")
+            search.rebuild_index(conn)
     click.echo("Tables created")
     user = User.query.first()
     if user is not None:
@@ -40,6 +108,226 @@ def drop_tables() -> None:
     click.echo("Tables dropped")
 
 
+@click.command(name="process-pending")
+def process_pending() -> None:
+    """Process images left pending by the background ingestion."""
+    count = ingest.process_pending()
+    click.echo(f"{count} pending image(s) processed.")
+
+
+@click.command(name="rebuild-search-index")
+def rebuild_search_index() -> None:
+    """Rebuild the full-text search index of images."""
+    with db.engine.begin() as conn:
+        if conn.dialect.name != "sqlite":
+            click.echo("Full-text search index is only supported on SQLite.")
+            return
+        count = search.rebuild_index(conn)
+    click.echo(f"{count} image(s) indexed.")
+
+
+def _sharded_key(key: str) -> str:
+    name = Path(key).name
+    if key.startswith(f"{imaging.THUMBNAIL_FOLDER}/"):
+        return storage.thumbnail_key(name)
+    if key.startswith(f"{imaging.RENDITION_FOLDER}/"):
+        return storage.rendition_key(name)
+    return storage.img_key(name)
+
+
+@click.command(name="reshard")
+@click.option("--batch-size", default=100, help="Images moved per transaction.")
+@click.option("--keep-old", is_flag=True, help="Keep files at the old keys.")
+def reshard(batch_size, keep_old) -> None:
+    """Move image files into the sharded layout, while the app keeps serving.
+
+    Files are copied to their new keys before the rows are switched, and the
+    old files are deleted once no committed row refers to them.
+    """
+    store = storage.get_storage()
+    moved = 0
+    last_id = 0
+    while True:
+        images = db.session.scalars(
+            db.select(Image)
+            .options(so.selectinload(Image.renditions))
+            .filter(Image.id > last_id)
+            .order_by(Image.id)
+            .limit(batch_size)
+        ).all()
+        if not images:
+            break
+        last_id = images[-1].id
+
+        old_keys = []
+        for img in images:
+            for row, attr in [
+                (img, "uri"),
+                (img, "thumbnail_uri"),
+                *((r, "uri") for r in img.renditions),
+            ]:
+                key = storage.key_of(getattr(row, attr))
+                new_key = _sharded_key(key)
+                if new_key == key:
+                    continue
+                if store.exists(key):
+                    store.copy(key, new_key)
+                setattr(row, attr, storage.uri_of(new_key))
+                row.keep_updated_at()
+                old_keys.append(key)
+        db.session.commit()
+
+        if not keep_old:
+            for key in old_keys:
+                store.delete(key)
+        moved += len(old_keys)
+        click.echo(f"{moved} file(s) moved, up to image {last_id}...")
+    click.echo("Done.")
+
+
+@click.command(name="regenerate")
+@click.option("--batch-size", default=64, help="Images committed per chunk.")
+@click.option("--force", is_flag=True, help="Rebuild up-to-date images too.")
+@click.option("--restart", is_flag=True, help="Ignore the last checkpoint.")
+def regenerate(batch_size, force, restart) -> None:
+    """Rebuild thumbnails, blurhashes, sizes and renditions of images.
+
+    Images are walked by id in chunks, each of which is derived across all
+    cores and committed on its own, and the last id committed is saved, so an
+    interrupted run goes on where it stopped.
+    """
+    checkpoint = Path(current_app.instance_path) / REGENERATE_CHECKPOINT
+    last_id = 0
+    if checkpoint.exists() and not restart:
+        last_id = int(checkpoint.read_text() or 0)
+        click.echo(f"Resuming after image {last_id}...")
+
+    store = storage.get_storage()
+    regenerated = skipped = failed = 0
+    while True:
+        images = db.session.scalars(
+            db.select(Image)
+            .options(so.selectinload(Image.renditions))
+            .filter(
+                Image.id > last_id,
+                Image.status.notin_([ImageStatus.PENDING, ImageStatus.DUPLICATE]),
+            )
+            .order_by(Image.id)
+            .limit(batch_size)
+        ).all()
+        if not images:
+            break
+        last_id = images[-1].id
+
+        todo = [img for img in images if force or not ingest.is_derived(img)]
+        skipped += len(images) - len(todo)
+        if todo:
+            batch_failed, stale_keys = ingest.regenerate(todo)
+            db.session.commit()
+            for key in stale_keys:
+                store.delete(key)
+            failed += batch_failed
+            regenerated += len(todo) - batch_failed
+        else:
+            db.session.rollback()
+        checkpoint.parent.mkdir(exist_ok=True, parents=True)
+        checkpoint.write_text(str(last_id))
+        click.echo(
+            f"{regenerated} regenerated, {skipped} skipped, {failed} failed, "
+            f"up to image {last_id}..."
+        )
+
+    checkpoint.unlink(missing_ok=True)
+    click.echo(f"Done, {regenerated} regenerated, {skipped} skipped, {failed} failed.")
+
+
+def _check_scratch_database(database: str | None) -> None:
+    """Refuse to seed unless the configured database is named on the command
+    line, so that a production one is never filled with synthetic rows."""
+    if not database:
+        raise click.UsageError(
+            "Pass --database with the URI of the configured database, "
+            "which is to be a scratch one."
+        )
+    try:
+        named = sa.make_url(database)
+    except sa.exc.ArgumentError as err:
+        raise click.BadParameter(str(err), param_hint="--database") from err
+    if named != db.engine.url:
+        raise click.BadParameter(
+            f"{database} is not the configured database "
+            f"{db.engine.url.render_as_string()}.",
+            param_hint="--database",
+        )
+
+
+@click.command(name="seed-benchmark")
+@click.option("--images", default=10_000, help="Count of synthetic images.")
+@click.option("--clear", is_flag=True, help="Delete the seeded images instead.")
+@click.option(
+    "--database", help="URI of the configured database, to seed it on purpose."
+)
+def seed_benchmark(images, clear, database) -> None:
+    """Seed a synthetic library for benchmarks, into a scratch database."""
+    from . import benchmark
+
+    _check_scratch_database(database)
+    if clear:
+        click.echo(f"{benchmark.clear()} seeded image(s) deleted.")
+        return
+    count = benchmark.seed(images)
+    click.echo(f"{count} image(s) seeded, {benchmark.seeded_count()} in total.")
+
+
+def _int_list(ctx, param, value: str) -> list[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+@click.command(name="benchmark")
+@click.option(
+    "--rows",
+    default="1000,10000,100000",
+    callback=_int_list,
+    help="Counts of rows to measure queries at, seeded as needed.",
+)
+@click.option("--repeat", default=5, help="Runs of each measure.")
+@click.option("--skip-imaging", is_flag=True, help="Measure queries only.")
+@click.option("--skip-queries", is_flag=True, help="Measure imaging only.")
+@click.option(
+    "--output", type=click.Path(dir_okay=False), help="JSON file of the results."
+)
+@click.option(
+    "--database", help="URI of the configured database, seeded to measure queries."
+)
+def run_benchmark(rows, repeat, skip_imaging, skip_queries, output, database) -> None:
+    """Benchmark the ingest pipeline and the query layer, in JSON."""
+    from . import benchmark
+
+    if not skip_queries:
+        _check_scratch_database(database)
+    records: list[dict] = []
+    results = {"environment": benchmark.environment(), "results": records}
+    if not skip_imaging:
+        click.echo("Benchmarking imaging...", err=True)
+        records.extend(benchmark.bench_imaging(repeat=repeat))
+    if not skip_queries:
+        click.echo("Benchmarking queries...", err=True)
+        records.extend(benchmark.bench_queries(rows, repeat=repeat))
+
+    dumped = json.dumps(results, indent=2)
+    if output:
+        Path(output).write_text(dumped)
+        click.echo(f"Results saved to {output}.", err=True)
+    else:
+        click.echo(dumped)
+
+
 def init_app(app: Flask) -> None:
     app.cli.add_command(create_tables)
     app.cli.add_command(drop_tables)
+    app.cli.add_command(process_pending)
+    app.cli.add_command(rebuild_search_index)
+    app.cli.add_command(reshard)
+    app.cli.add_command(regenerate)
+    app.cli.add_command(seed_benchmark)
+    app.cli.add_command(run_benchmark)
@@ -0,0 +1,82 @@
+"""SQLite tuned for many worker processes.
+
+Every SQLite connection is set up with WAL, so that readers never block
+behind the writer, and with a busy timeout, so that writers queue up instead
+of failing at once. A transaction which read a snapshot before another one
+committed still fails with "database is locked" on write, which is retried
+as a whole by `retry_on_locked`.
+"""
+
+import functools
+import os
+import random
+import sqlite3
+import time
+
+from flask import abort
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+from .models import db
+
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+# negative for KiB rather than pages
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE", -64 * 1024))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+WRITE_RETRIES = int(os.environ.get("WRITE_RETRIES", 5))
+WRITE_RETRY_DELAY = float(os.environ.get("WRITE_RETRY_DELAY", 0.05))
+
+
+@event.listens_for(Engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    if isinstance(dbapi_conn, sqlite3.Connection):
+        set_pragmas(dbapi_conn)
+
+
+def set_pragmas(dbapi_conn) -> None:
+    """Tune a SQLite connection, also one of an async driver."""
+    cursor = dbapi_conn.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size = {SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.close()
+
+
+def is_locked(err: OperationalError) -> bool:
+    return isinstance(err.orig, sqlite3.OperationalError) and (
+        "locked" in str(err.orig) or "busy" in str(err.orig)
+    )
+
+
+def retry_on_locked(fn):
+    """Retry a write transaction when the database is locked, with backoff.
+
+    The function is run again from scratch after a rollback, so it has to
+    make all its reads and writes in the session, and commit at its end.
+    Answers 503 when the retries run out.
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                return fn(*args, **kwargs)
+            except OperationalError as err:
+                db.session.rollback()
+                if not is_locked(err):
+                    raise
+                if attempt == WRITE_RETRIES:
+                    logger.error(f"Database still locked after {attempt} retries.")
+                    abort(503)
+                delay = WRITE_RETRY_DELAY * 2**attempt * random.uniform(0.5, 1.5)
+                logger.warning(f"Database locked, retrying in {delay:.3f}s...")
+                time.sleep(delay)
+
+    return wrapper
@@ -0,0 +1,95 @@
+"""Near duplicates of images, by the Hamming distance of their perceptual hashes.
+
+The 64 bits of a hash are split into `BANDS` bands of 16 bits, each of them
+indexed. Two hashes differing in less bits than there are bands are equal in
+one band at least, so candidates are looked up by their bands exactly, and
+only these are compared bit by bit (multi-index hashing). Hashes further
+apart may still be found, though not for sure.
+"""
+
+import os
+from collections import defaultdict
+
+import sqlalchemy as sa
+
+from .models import db, Image
+
+BANDS = 4
+BAND_BITS = 16
+NEAR_DUPLICATE_DISTANCE = int(os.environ.get("NEAR_DUPLICATE_DISTANCE", BANDS - 1))
+
+_band_columns = [Image.phash_0, Image.phash_1, Image.phash_2, Image.phash_3]
+
+
+def bands(phash: str) -> list[int]:
+    """Bands of a hash, from the highest bits."""
+    bits = int(phash, 16)
+    mask = (1 << BAND_BITS) - 1
+    return [bits >> (BAND_BITS * (BANDS - 1 - i)) & mask for i in range(BANDS)]
+
+
+def distance(a: str, b: str) -> int:
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+def set_phash(img: Image, phash: str | None) -> None:
+    img.phash = phash
+    values: list[int | None] = [*bands(phash)] if phash else [None] * BANDS
+    for column, value in zip(_band_columns, values):
+        setattr(img, column.key, value)
+
+
+def find_near(
+    phash: str,
+    max_distance: int = NEAR_DUPLICATE_DISTANCE,
+    exclude_id: int | None = None,
+) -> list[tuple[int, int]]:
+    """Images near a hash, as (id, distance) from the nearest."""
+    query = db.select(Image.id, Image.phash).filter(
+        sa.or_(*(c == v for c, v in zip(_band_columns, bands(phash))))
+    )
+    if exclude_id is not None:
+        query = query.filter(Image.id != exclude_id)
+    near = [
+        (image_id, distance(phash, other))
+        for image_id, other in db.session.execute(query)
+    ]
+    return sorted((n for n in near if n[1] <= max_distance), key=lambda n: n[1])
+
+
+def clusters(max_distance: int = NEAR_DUPLICATE_DISTANCE) -> list[list[int]]:
+    """Ids of images in groups of near duplicates, each of two images at least.
+
+    Images sharing a band are compared pairwise, and near pairs are joined
+    transitively.
+    """
+    rows = db.session.execute(
+        db.select(Image.id, Image.phash).filter(Image.phash.isnot(None))
+    ).all()
+    buckets = defaultdict(list)
+    for image_id, phash in rows:
+        for i, value in enumerate(bands(phash)):
+            buckets[i, value].append((image_id, int(phash, 16)))
+
+    parents: dict[int, int] = {}
+
+    def _find(image_id: int) -> int:
+        root = image_id
+        while parents.get(root, root) != root:
+            root = parents[root]
+        if root != image_id:
+            parents[image_id] = root
+        return root
+
+    for members in buckets.values():
+        for i, (a, a_bits) in enumerate(members):
+            for b, b_bits in members[i + 1 :]:
+                if (a_bits ^ b_bits).bit_count() <= max_distance:
+                    root_a, root_b = _find(a), _find(b)
+                    if root_a != root_b:
+                        parents[max(root_a, root_b)] = min(root_a, root_b)
+
+    groups = defaultdict(list)
+    for image_id in parents:
+        groups[_find(image_id)].append(image_id)
+    return [sorted({root, *ids}) for root, ids in sorted(groups.items())]
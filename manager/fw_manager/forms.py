@@ -4,6 +4,7 @@ from wtforms.fields.simple import StringField, FileField, SubmitField, TextAreaF
 from wtforms.validators import InputRequired, Length
 
 ALLOWED_IMAGE_TYPES = ["jpeg", "gif", "png"]
+TITLE_MAX_LENGTH = 100
 
 
 class UploadImageForm(FlaskForm):
@@ -16,7 +17,7 @@ class UploadImageForm(FlaskForm):
     )
     title = StringField(
         "Title",
-        validators=[InputRequired(), Length(1, 100)],
+        validators=[InputRequired(), Length(1, TITLE_MAX_LENGTH)],
     )
     position = StringField("Position")
     description = StringField("Description")
@@ -26,7 +27,7 @@ class UploadImageForm(FlaskForm):
 class EditImageForm(FlaskForm):
     title = StringField(
         "Title",
-        validators=[InputRequired(), Length(1, 100)],
+        validators=[InputRequired(), Length(1, TITLE_MAX_LENGTH)],
     )
     position = StringField("Position")
     description = StringField("Description")
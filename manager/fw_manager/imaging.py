@@ -0,0 +1,329 @@
+import base64
+import io
+import os
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import cast
+
+import blurhash
+from PIL import ExifTags, ImageOps, Image as PImage
+
+from .forms import ALLOWED_IMAGE_TYPES
+
+IMG_FOLDER = os.environ.get("IMG_FOLDER_NAME", "img")
+THUMBNAIL_FOLDER = os.environ.get("THUMBNAIL_FOLDER_NAME", "thumbnail")
+THUMBNAIL_MAX_WIDTH = int(os.environ.get("THUMBNAIL_MAX_WIDTH", 600))
+RENDITION_FOLDER = os.environ.get("RENDITION_FOLDER_NAME", "rendition")
+RENDITION_WIDTHS = [
+    int(w)
+    for w in os.environ.get("RENDITION_WIDTHS", "320,640,1280,1920").split(",")
+    if w
+]
+RENDITION_FORMATS = [
+    f for f in os.environ.get("RENDITION_FORMATS", "webp,avif").split(",") if f
+]
+RENDITION_QUALITY = int(os.environ.get("RENDITION_QUALITY", 80))
+# `passthrough` stores originals byte for byte, `reencode` saves them by PIL
+ORIGINALS_MODE = os.environ.get("ORIGINALS_MODE", "passthrough")
+# budgets of one decode, i.e. pixels of an image and bytes of its bitmap
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 100_000_000))
+MAX_DECODE_BYTES = int(os.environ.get("MAX_DECODE_BYTES", 256 * 1024 * 1024))
+BLURHASH_SAMPLE_WIDTH = int(os.environ.get("BLURHASH_SAMPLE_WIDTH", 64))
+# the perceptual hash is of 8x8 bits
+PHASH_SIZE = 8
+# placeholders decoded from blurhashes, by their longer side
+PLACEHOLDER_SIZE = int(os.environ.get("PLACEHOLDER_SIZE", 32))
+PLACEHOLDER_FORMAT = os.environ.get("PLACEHOLDER_FORMAT", "webp")
+
+PImage.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+class InvalidImageError(Exception):
+    pass
+
+
+class ImageTooLargeError(InvalidImageError):
+    pass
+
+
+@contextmanager
+def _timed(timings: dict | None, phase: str):
+    start = time.perf_counter()
+    yield
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0) + time.perf_counter() - start
+
+
+@contextmanager
+def _pil_errors():
+    """Errors PIL raises of an image it fails to read or write, e.g. truncated
+    or of an unknown extension, as errors of the image."""
+    try:
+        yield
+    except PImage.DecompressionBombError as err:
+        raise ImageTooLargeError(str(err)) from err
+    except (OSError, ValueError, SyntaxError) as err:
+        raise InvalidImageError(str(err)) from err
+
+
+def _open(img_path: Path) -> PImage.Image:
+    with _pil_errors():
+        return PImage.open(img_path)
+
+
+def _check(img: PImage.Image) -> None:
+    if (img.format or "").lower() not in ALLOWED_IMAGE_TYPES:
+        raise InvalidImageError(f"Unsupported image format: {img.format}")
+    w, h = img.size
+    if w * h > MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(f"Image of {w}x{h} exceeds {MAX_IMAGE_PIXELS} pixels")
+
+
+def _check_decode(img: PImage.Image) -> None:
+    """Check the bitmap to decode, which is reduced by `draft` if possible."""
+    w, h = img.size
+    decode_bytes = w * h * len(img.getbands())
+    if decode_bytes > MAX_DECODE_BYTES:
+        raise ImageTooLargeError(
+            f"Decoding {w}x{h} {img.mode} takes {decode_bytes} bytes, "
+            f"exceeding {MAX_DECODE_BYTES} bytes"
+        )
+
+
+def _oriented_size(img: PImage.Image) -> tuple[int, int]:
+    """Size of an image as shown, i.e. rotated by its EXIF orientation, which is
+    read from the header."""
+    w, h = img.size
+    # `getexif` loads a PNG without EXIF in its header, to look for it after
+    # the pixels, so the header alone is looked at
+    if "exif" not in img.info:
+        return w, h
+    if img.getexif().get(ExifTags.Base.Orientation) in [5, 6, 7, 8]:
+        return h, w
+    return w, h
+
+
+def _draft(img: PImage.Image, size: tuple[int, int]) -> None:
+    """`draft` by a size as the image is shown."""
+    if _oriented_size(img) != img.size:
+        size = (size[1], size[0])
+    img.draft(None, size)
+
+
+def probe(img_path: Path) -> tuple[int, int]:
+    """Validate an image by reading its header only, returns its size as
+    shown."""
+    with _pil_errors(), _open(img_path) as img:
+        _check(img)
+        return _oriented_size(img)
+
+
+def reencode(img_path: Path) -> None:
+    """Save an image by PIL in place, which strips its metadata."""
+    with _pil_errors():
+        with _open(img_path) as pil_img:
+            _check(pil_img)
+            _check_decode(pil_img)
+            pil_img.load()
+            # the orientation goes along with the metadata, so the pixels turn
+            ImageOps.exif_transpose(pil_img, in_place=True)
+        if img_path.suffix.lower() in [".jpg", ".jpeg"] and pil_img.mode == "RGBA":
+            pil_img = pil_img.convert("RGB")
+        pil_img.save(img_path)
+
+
+def available_rendition_formats() -> list[str]:
+    """Rendition formats PIL is able to save, e.g. AVIF needs a plugin."""
+    extensions = PImage.registered_extensions()
+    return [f for f in RENDITION_FORMATS if extensions.get(f".{f}") in PImage.SAVE]
+
+
+def derivation_version() -> str:
+    """Settings derivatives are generated by, which tells outdated ones."""
+    return ";".join(
+        [
+            str(THUMBNAIL_MAX_WIDTH),
+            ",".join(map(str, RENDITION_WIDTHS)),
+            ",".join(available_rendition_formats()),
+            str(RENDITION_QUALITY),
+            f"dhash{PHASH_SIZE}",
+            # turned by EXIF orientation, unlike derivatives made before
+            "oriented",
+        ]
+    )
+
+
+def dhash(img: PImage.Image) -> str:
+    """Difference hash of a loaded image in hex, of whether each pixel of a
+    tiny grayscale sample is brighter than the one to its right.
+
+    It is kept by resizing and recompressing, so the hashes of the same shot
+    differ in a few bits at most.
+    """
+    sample = img.convert("L").resize(
+        (PHASH_SIZE + 1, PHASH_SIZE), PImage.Resampling.LANCZOS
+    )
+    pixels = sample.tobytes()
+    bits = 0
+    for row in range(PHASH_SIZE):
+        for col in range(PHASH_SIZE):
+            i = row * (PHASH_SIZE + 1) + col
+            bits = bits << 1 | (pixels[i] > pixels[i + 1])
+    return f"{bits:0{PHASH_SIZE * PHASH_SIZE // 4}x}"
+
+
+def gen_renditions(src_img: PImage.Image, folder: Path, name: str) -> list[dict]:
+    """Save downsized variants of a loaded image for each width and format.
+
+    Widths not less than the image are skipped, since the original serves.
+    """
+    w, h = src_img.size
+    widths = sorted((rw for rw in RENDITION_WIDTHS if rw < w), reverse=True)
+    formats = available_rendition_formats()
+    if not widths or not formats:
+        return []
+
+    folder.mkdir(exist_ok=True, parents=True)
+    img = src_img
+    if img.mode not in ["RGB", "RGBA"]:
+        img = img.convert("RGBA" if img.has_transparency_data else "RGB")
+    renditions = []
+    for width in widths:
+        # downsized from the previous, larger variant
+        img = img.resize(
+            (width, max(1, round(width / w * h))), PImage.Resampling.LANCZOS
+        )
+        for fmt in formats:
+            path = folder / f"{name}_{width}.{fmt}"
+            img.save(path, quality=RENDITION_QUALITY)
+            renditions.append(
+                {
+                    "uri": path.as_posix(),
+                    "width": img.width,
+                    "height": img.height,
+                    "format": fmt,
+                    "size": path.stat().st_size,
+                }
+            )
+    return renditions
+
+
+@lru_cache(maxsize=4096)
+def placeholder(img_hash: str, width: int, height: int) -> str:
+    """A tiny image decoded from a blurhash, as a data URI of a hundred bytes
+    or so, which clients paint before the image without decoding by JS.
+
+    PNG is used if PIL is not able to save `PLACEHOLDER_FORMAT`.
+    """
+    if not img_hash or not width or not height:
+        return ""
+    if width >= height:
+        size = (PLACEHOLDER_SIZE, max(1, round(PLACEHOLDER_SIZE / width * height)))
+    else:
+        size = (max(1, round(PLACEHOLDER_SIZE / height * width)), PLACEHOLDER_SIZE)
+    try:
+        img = blurhash.decode(img_hash, *size)
+    except (blurhash.BlurhashDecodeError, ValueError):
+        return ""
+    fmt = PLACEHOLDER_FORMAT.lower()
+    if PImage.registered_extensions().get(f".{fmt}") not in PImage.SAVE:
+        fmt = "png"
+    buffer = io.BytesIO()
+    img.save(buffer, fmt, quality=50)
+    return f"data:image/{fmt};base64,{base64.b64encode(buffer.getvalue()).decode()}"
+
+
+def gen_thumbnail(
+    src_img: PImage.Image, timings: dict | None = None
+) -> tuple[PImage.Image, str]:
+    """Reduce an image not loaded yet to its thumbnail in place, turned by its
+    EXIF orientation.
+
+    JPEG is decoded straight at the smallest DCT scale no less than twice the
+    thumbnail, and the blurhash is computed from a tiny sample of it. Seconds
+    taken by each phase are added to `timings` if given.
+    """
+    w, h = _oriented_size(src_img)
+    size = (THUMBNAIL_MAX_WIDTH, round(THUMBNAIL_MAX_WIDTH / w * h))
+    _draft(src_img, (size[0] * 2, size[1] * 2))
+    _check_decode(src_img)
+    with _timed(timings, "decode"):
+        src_img.load()
+    with _timed(timings, "thumbnail"):
+        ImageOps.exif_transpose(src_img, in_place=True)
+        src_img.thumbnail(size)
+
+    with _timed(timings, "blurhash"):
+        sample = src_img.copy()
+        sample.thumbnail((BLURHASH_SAMPLE_WIDTH, BLURHASH_SAMPLE_WIDTH))
+        img_hash = blurhash.encode(
+            sample, 4, 4
+        )  # `blurhash.encode` will close the img passed in
+    return src_img, img_hash
+
+
+def derive(
+    img_path: Path,
+    thumbnail_path: Path,
+    rendition_folder: Path | None = None,
+    reencode_original: bool | None = None,
+) -> dict:
+    """Generate the thumbnail of an image on disk, and its renditions if a
+    folder is given, returns its blurhash and placeholder, perceptual hash,
+    size, renditions and the seconds taken by each phase.
+
+    The original is re-encoded first by `ORIGINALS_MODE`, unless told
+    otherwise. Only plain data goes in and out, so that it can be run in a
+    worker thread or process without an app context.
+    """
+    timings: dict[str, float] = {}
+    if reencode_original is None:
+        reencode_original = ORIGINALS_MODE == "reencode"
+    if reencode_original:
+        with _timed(timings, "reencode"):
+            reencode(img_path)
+    renditions = []
+    try:
+        with _pil_errors(), _open(img_path) as pil_img:
+            _check(pil_img)
+            w, h = _oriented_size(pil_img)
+            if rendition_folder is not None and any(rw < w for rw in RENDITION_WIDTHS):
+                # decoded once for all the variants, as small as the largest one
+                largest = max(rw for rw in RENDITION_WIDTHS if rw < w)
+                _draft(pil_img, (largest, round(largest / w * h)))
+                _check_decode(pil_img)
+                with _timed(timings, "decode"):
+                    pil_img.load()
+                with _timed(timings, "renditions"):
+                    renditions = gen_renditions(
+                        cast(PImage.Image, ImageOps.exif_transpose(pil_img)),
+                        rendition_folder,
+                        img_path.stem,
+                    )
+            thumbnail, img_hash = gen_thumbnail(pil_img, timings)
+            with _timed(timings, "phash"):
+                img_phash = dhash(thumbnail)
+            if (
+                thumbnail_path.suffix.lower() in [".jpg", ".jpeg"]
+                and thumbnail.mode == "RGBA"
+            ):
+                thumbnail = thumbnail.convert("RGB")
+            with _timed(timings, "save"):
+                thumbnail.save(thumbnail_path)
+    except Exception:
+        if rendition_folder is not None:
+            for path in rendition_folder.glob(f"{img_path.stem}_*"):
+                path.unlink(missing_ok=True)
+        raise
+    return {
+        "blurhash": img_hash,
+        "placeholder": placeholder(img_hash, w, h),
+        "phash": img_phash,
+        "width": w,
+        "height": h,
+        "renditions": renditions,
+        "derivation": derivation_version(),
+        "timings": timings,
+    }
@@ -0,0 +1,262 @@
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from pathlib import Path
+from threading import Lock
+
+from flask import Flask, current_app
+from loguru import logger
+
+from . import admission, duplicates, imaging, metrics, storage
+from .models import db, Image, ImageStatus, Rendition
+from .utils import as_bool
+
+INGEST_ASYNC = as_bool(os.environ.get("INGEST_ASYNC", False))
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 2))
+INGEST_PROCESSES = int(os.environ.get("INGEST_PROCESSES", os.cpu_count() or 1))
+
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = Lock()
+_process_pool: ProcessPoolExecutor | None = None
+_process_pool_lock = Lock()
+_jobs: dict[int, Future] = {}
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=INGEST_WORKERS, thread_name_prefix="fw-ingest"
+            )
+    return _executor
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawned rather than forked, as the app may be running threads
+            _process_pool = ProcessPoolExecutor(
+                max_workers=INGEST_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return _process_pool
+
+
+def _submit_admitted(args: tuple) -> Future:
+    """Submit `imaging.derive` to the process pool once the image holds its
+    decode slots, waited for as long as it takes, which are released as soon
+    as it is derived."""
+    width, height = imaging.probe(args[0])
+    slots = ExitStack()
+    slots.enter_context(admission.admit(width * height, timeout=None))
+    try:
+        future = _get_process_pool().submit(imaging.derive, *args)
+    except BaseException:
+        slots.close()
+        raise
+    future.add_done_callback(lambda _: slots.close())
+    return future
+
+
+def derive_many(paths: list[tuple]) -> list[dict | Exception]:
+    """Run `imaging.derive` for many images in the process pool, as many at
+    once as decode slots are there, which is fewer than the cores unless
+    `ADMISSION_SLOTS` is raised.
+
+    Returns the result of each image in order, or the exception it raised.
+    """
+    global _process_pool
+    futures: list[Future | Exception] = []
+    for p in paths:
+        try:
+            futures.append(_submit_admitted(p))
+        except Exception as err:
+            futures.append(err)
+    results: list[dict | Exception] = []
+    for future in futures:
+        if isinstance(future, Exception):
+            results.append(future)
+            continue
+        try:
+            results.append(future.result())
+        except BrokenProcessPool as err:
+            with _process_pool_lock:
+                _process_pool = None
+            results.append(err)
+        except Exception as err:
+            results.append(err)
+    return results
+
+
+def derive_args(img_path: Path, folder: Path, reencode: bool | None = None) -> tuple:
+    """Arguments of `imaging.derive` for a local original, which writes the
+    derivatives into a work folder.
+    """
+    (folder / imaging.THUMBNAIL_FOLDER).mkdir(exist_ok=True)
+    return (
+        img_path,
+        folder / imaging.THUMBNAIL_FOLDER / img_path.name,
+        folder / imaging.RENDITION_FOLDER,
+        reencode,
+    )
+
+
+def store_derived(name: str, folder: Path, meta: dict) -> dict:
+    """Move derivatives of an image from a work folder into the storage, at
+    keys of the derivation version they were made by."""
+    store = storage.get_storage()
+    thumbnail_key = storage.thumbnail_key(name, meta["derivation"])
+    store.put(thumbnail_key, folder / imaging.THUMBNAIL_FOLDER / name)
+    renditions = []
+    for r in meta["renditions"]:
+        key = storage.rendition_key(Path(r["uri"]).name, meta["derivation"])
+        store.put(key, Path(r["uri"]))
+        renditions.append(r | {"uri": storage.uri_of(key)})
+    return meta | {
+        "thumbnail_uri": storage.uri_of(thumbnail_key),
+        "renditions": renditions,
+    }
+
+
+def apply_derived(img: Image, meta: dict) -> None:
+    """Fill an image by the result of `store_derived`.
+
+    Renditions of the same URI are updated in place, as they are unique.
+    """
+    for phase, seconds in meta.get("timings", {}).items():
+        metrics.record_phase(phase, seconds)
+    img.thumbnail_uri = meta["thumbnail_uri"]
+    img.blurhash = meta["blurhash"]
+    img.placeholder = meta["placeholder"]
+    duplicates.set_phash(img, meta["phash"])
+    img.width = meta["width"]
+    img.height = meta["height"]
+    img.derivation = meta["derivation"]
+    existing = {r.uri: r for r in img.renditions}
+    renditions = []
+    for r in meta["renditions"]:
+        rendition = existing.get(r["uri"]) or Rendition(uri=r["uri"])
+        rendition.width = r["width"]
+        rendition.height = r["height"]
+        rendition.format = r["format"]
+        rendition.size = r["size"]
+        renditions.append(rendition)
+    img.renditions = renditions
+
+
+def _process(app: Flask, image_id: int, check_near: bool = True) -> str:
+    with app.app_context():
+        img = db.session.get(Image, image_id)
+        if not img or img.status != ImageStatus.PENDING:
+            return img.status if img else ImageStatus.FAILED
+
+        store = storage.get_storage()
+        key = storage.key_of(img.uri)
+        logger.info(f"Processing image {image_id}...")
+        try:
+            with storage.work_folder() as folder, store.fetch(key) as src:
+                width, height = imaging.probe(src)
+                # queued jobs wait for decode slots as long as it takes
+                with admission.admit(width * height, timeout=None):
+                    meta = imaging.derive(*derive_args(src, folder))
+                near = (
+                    duplicates.find_near(meta["phash"], exclude_id=image_id)
+                    if check_near
+                    else []
+                )
+                if near:
+                    logger.info(f"Image {image_id} is near image {near[0][0]}.")
+                    img.status = ImageStatus.DUPLICATE
+                    db.session.commit()
+                    return img.status
+                if imaging.ORIGINALS_MODE == "reencode":
+                    # re-encoded in place, which may be a local copy only
+                    store.put(key, src)
+                meta = store_derived(Path(key).name, folder, meta)
+        except Exception as err:
+            logger.error(f"Failed to process image {image_id}: {err!r}")
+            img.status = ImageStatus.FAILED
+        else:
+            apply_derived(img, meta)
+            img.status = ImageStatus.READY
+            logger.info("Done.")
+        db.session.commit()
+        return img.status
+
+
+def is_derived(img: Image) -> bool:
+    """Whether derivatives of an image are there, and by the current settings."""
+    return bool(
+        img.derivation == imaging.derivation_version()
+        and img.blurhash
+        and img.placeholder
+        and img.width
+        and img.height
+        and storage.get_storage().exists(storage.key_of(img.thumbnail_uri))
+    )
+
+
+def regenerate(images: list[Image]) -> tuple[int, list[str]]:
+    """Rebuild derivatives of images in the process pool, originals and the time
+    the images were updated are left as they are.
+
+    Returns the count of failures, and the keys of files replaced, which are to
+    be deleted once the images are committed.
+    """
+    store = storage.get_storage()
+    failed = 0
+    stale_keys: list[str] = []
+    with storage.work_folder() as folder, ExitStack() as stack:
+        srcs = [
+            stack.enter_context(store.fetch(storage.key_of(img.uri))) for img in images
+        ]
+        derived = derive_many(
+            [derive_args(src, folder, reencode=False) for src in srcs]
+        )
+        for img, src, meta in zip(images, srcs, derived):
+            if isinstance(meta, Exception):
+                logger.error(f"Failed to regenerate image {img.id}: {meta!r}")
+                failed += 1
+                continue
+            old_uris = {img.thumbnail_uri, *(r.uri for r in img.renditions)}
+            apply_derived(img, store_derived(src.name, folder, meta))
+            img.status = ImageStatus.READY
+            img.keep_updated_at()
+            new_uris = {img.thumbnail_uri, *(r.uri for r in img.renditions)}
+            stale_keys.extend(storage.key_of(uri) for uri in old_uris - new_uris)
+    return failed, stale_keys
+
+
+def submit(image_id: int, check_near: bool = True) -> Future:
+    """Queue a pending image for thumbnail, blurhash and size generation.
+
+    It ends as `ImageStatus.DUPLICATE` if `check_near` and near duplicates of it
+    are there, which images left pending by a restart are checked for too.
+    """
+    app = current_app._get_current_object()  # type: ignore[attr-defined]
+    future = _get_executor().submit(_process, app, image_id, check_near)
+    _jobs[image_id] = future
+    future.add_done_callback(lambda _: _jobs.pop(image_id, None))
+    return future
+
+
+def wait(image_id: int, timeout: float | None = None) -> None:
+    """Block until the job of an image queued by this process is finished."""
+    future = _jobs.get(image_id)
+    if future is not None:
+        future.result(timeout=timeout)
+
+
+def process_pending() -> int:
+    """Process pending images inline, e.g. those left by a restarted worker."""
+    app = current_app._get_current_object()  # type: ignore[attr-defined]
+    pending = db.session.scalars(
+        db.select(Image.id).filter_by(status=ImageStatus.PENDING)
+    ).all()
+    for image_id in pending:
+        _process(app, image_id)
+    return len(pending)
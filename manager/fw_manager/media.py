@@ -0,0 +1,62 @@
+"""Serving of image files, which can be offloaded to the front proxy.
+
+Behind nginx, the proxy opts in by sending an `X-Accel-Offload` header with
+the prefix of its internal location of the static folder, and the file is
+then answered by an `X-Accel-Redirect` to it. `IMAGE_OFFLOAD=x-sendfile`
+enables `X-Sendfile` for proxies like Apache or lighttpd instead.
+
+Image files kept by a remote storage backend are redirected to.
+"""
+
+import mimetypes
+import os
+import re
+from pathlib import Path
+from typing import cast
+
+from flask import Flask, Response, abort, current_app, redirect, request
+from werkzeug.security import safe_join
+from werkzeug.wrappers import Response as BaseResponse
+
+from . import storage
+from .imaging import IMG_FOLDER
+
+IMAGE_OFFLOAD = os.environ.get("IMAGE_OFFLOAD", "")
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# files named by the hash of their content never change
+_content_named = re.compile(r"^[0-9a-f]{64}")
+
+
+def _accel_redirect(prefix: str, filename: str) -> Response:
+    path = safe_join(cast(str, current_app.static_folder), filename)
+    if path is None or not Path(path).is_file():
+        abort(404)
+    resp = Response(mimetype=mimetypes.guess_type(filename)[0])
+    resp.headers["X-Accel-Redirect"] = f"{prefix.rstrip('/')}/{filename}"
+    return resp
+
+
+def send_static_file(filename: str) -> BaseResponse:
+    if filename.startswith(f"{IMG_FOLDER}/"):
+        url = storage.get_storage().url(filename.removeprefix(f"{IMG_FOLDER}/"))
+        if url:
+            return redirect(url)
+
+    prefix = request.headers.get("X-Accel-Offload")
+    if prefix:
+        resp = _accel_redirect(prefix, filename)
+    else:
+        # honors Range and conditional requests, or sends `X-Sendfile`
+        resp = current_app.send_static_file(filename)
+    if _content_named.match(Path(filename).name):
+        resp.cache_control.public = True
+        resp.cache_control.max_age = IMMUTABLE_MAX_AGE
+        resp.cache_control.immutable = True
+        resp.cache_control.no_cache = None
+    return resp
+
+
+def init_app(app: Flask) -> None:
+    app.config["USE_X_SENDFILE"] = IMAGE_OFFLOAD == "x-sendfile"
+    app.view_functions["static"] = send_static_file
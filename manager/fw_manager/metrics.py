@@ -0,0 +1,332 @@
+"""Metrics of requests, ingest phases and SQL, in the Prometheus text format.
+
+Each process keeps its own metrics in memory, and saves them as a file of its
+own in `METRICS_FOLDER`, at most every `METRICS_FLUSH_INTERVAL` seconds and as
+it exits. Metrics held back by the interval are saved by a timer as it ends.
+`/metrics` sums up the files, so it is correct whichever worker answers it, and
+asks for the credentials of the manager.
+Durations of the spans of a request also go out in its `Server-Timing` header.
+"""
+
+import atexit
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock, Timer
+from typing import Callable
+from uuid import uuid4
+
+import sqlalchemy as sa
+from flask import Flask, Response, current_app, g, has_request_context, request
+
+METRICS_FOLDER = os.environ.get("METRICS_FOLDER", "")
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 1))
+
+DURATION_BUCKETS = [
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+]
+
+# name: (type, help)
+METRICS = {
+    "fw_http_request_duration_seconds": (
+        "histogram",
+        "Duration of HTTP requests.",
+    ),
+    "fw_ingest_phase_duration_seconds": (
+        "histogram",
+        "Duration of each phase of ingesting an image.",
+    ),
+    "fw_sql_query_duration_seconds": ("histogram", "Duration of SQL statements."),
+    "fw_responses_total": ("counter", "Responses by error code."),
+    "fw_bulk_items_total": ("counter", "Files of bulk uploads by error code."),
+    "fw_image_bytes_total": ("counter", "Bytes of uploaded images processed."),
+    "fw_admission_wait_seconds": (
+        "histogram",
+        "Time waited for decode slots.",
+    ),
+    "fw_admission_rejected_total": (
+        "counter",
+        "Requests rejected for want of decode slots.",
+    ),
+}
+
+# name: (help, function of the value), of values read across the processes
+# as they are scraped
+_gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+
+
+class Registry:
+    """Counters and histograms of a process, by name and labels."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters: dict[tuple, float] = {}
+        self.histograms: dict[tuple, list] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            # counts of each bucket, then the +Inf one, the sum and the count
+            hist = self.histograms.setdefault(key, [0] * (len(DURATION_BUCKETS) + 3))
+            hist[bisect_left(DURATION_BUCKETS, value)] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def dump(self) -> dict:
+        with self.lock:
+            return {
+                "counters": [[n, dict(ls), v] for (n, ls), v in self.counters.items()],
+                "histograms": [
+                    [n, dict(ls), h] for (n, ls), h in self.histograms.items()
+                ],
+            }
+
+    def load(self, data: dict) -> None:
+        """Add up metrics dumped by another process."""
+        with self.lock:
+            for name, labels, value in data["counters"]:
+                key = (name, tuple(sorted(labels.items())))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, values in data["histograms"]:
+                key = (name, tuple(sorted(labels.items())))
+                hist = self.histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    hist[i] += value
+
+
+_registry = Registry()
+_pid = os.getpid()
+_file_name = f"{_pid}-{uuid4().hex}.json"
+_flush_lock = Lock()
+_last_flush = 0.0
+_flush_timer: Timer | None = None
+# where the metrics are saved, known once flushed in an app context
+_flush_folder: Path | None = None
+
+
+def _process_registry() -> Registry:
+    # metrics copied into a forked worker belong to its parent
+    global _registry, _pid, _file_name, _flush_timer
+    if os.getpid() != _pid:
+        _registry = Registry()
+        _pid = os.getpid()
+        _file_name = f"{_pid}-{uuid4().hex}.json"
+        # the timer thread is not forked along
+        _flush_timer = None
+    return _registry
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    _process_registry().inc(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    _process_registry().observe(name, value, **labels)
+
+
+def _add_span(name: str, seconds: float) -> None:
+    if has_request_context():
+        spans = g.setdefault("metric_spans", {})
+        spans[name] = spans.get(name, 0) + seconds
+
+
+def record_phase(phase: str, seconds: float) -> None:
+    observe("fw_ingest_phase_duration_seconds", seconds, phase=phase)
+    _add_span(phase, seconds)
+
+
+@contextmanager
+def span(phase: str):
+    """Time a phase of ingesting an image."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - start)
+
+
+def record_response(err_code: str) -> None:
+    if has_request_context():
+        inc("fw_responses_total", endpoint=request.endpoint, err_code=err_code)
+
+
+def gauge(name: str, help_text: str, fn: Callable[[], float]) -> None:
+    _gauges[name] = (help_text, fn)
+
+
+def metrics_folder() -> Path:
+    folder = Path(METRICS_FOLDER or Path(current_app.instance_path) / "metrics")
+    folder.mkdir(exist_ok=True, parents=True)
+    return folder
+
+
+def _write() -> None:
+    """Save the metrics to the flush folder, under the flush lock."""
+    global _last_flush, _flush_timer
+    if _flush_folder is None:
+        return
+    _last_flush = time.monotonic()
+    if _flush_timer is not None:
+        _flush_timer.cancel()
+        _flush_timer = None
+    registry = _process_registry()
+    tmp_path = _flush_folder / f".{_file_name}"
+    tmp_path.write_text(json.dumps(registry.dump()))
+    tmp_path.replace(_flush_folder / _file_name)
+
+
+@atexit.register
+def _write_pending() -> None:
+    with _flush_lock:
+        _write()
+
+
+def flush(force: bool = False) -> None:
+    """Save the metrics of this process, for `/metrics` of any worker.
+
+    Unless forced, they are saved at most every `METRICS_FLUSH_INTERVAL`, and
+    the ones held back by a timer as it ends, so none stay in a worker gone
+    idle.
+    """
+    global _flush_folder, _flush_timer
+    _flush_folder = metrics_folder()
+    _process_registry()
+    with _flush_lock:
+        wait = _last_flush + METRICS_FLUSH_INTERVAL - time.monotonic()
+        if force or wait <= 0:
+            _write()
+        elif _flush_timer is None:
+            _flush_timer = Timer(wait, _write_pending)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+
+def collect() -> Registry:
+    """Metrics summed up across the processes."""
+    flush(force=True)
+    total = Registry()
+    for path in metrics_folder().glob("*.json"):
+        try:
+            total.load(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def render(registry: Registry) -> str:
+    lines = []
+    data = registry.dump()
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type == "counter":
+            for n, labels, value in data["counters"]:
+                if n == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            continue
+        for n, labels, hist in data["histograms"]:
+            if n != name:
+                continue
+            cumulative = 0
+            for le, count in zip([*DURATION_BUCKETS, "+Inf"], hist[:-2]):
+                cumulative += count
+                bucket_labels = _format_labels(labels | {"le": le})
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {hist[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {hist[-1]}")
+    for name, (help_text, fn) in _gauges.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {fn()}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view() -> Response:
+    return Response(render(collect()), content_type="text/plain; version=0.0.4")
+
+
+def _before_request():
+    g.metric_start = time.perf_counter()
+
+
+def _after_request(resp: Response) -> Response:
+    start = g.pop("metric_start", None)
+    if start is None:
+        return resp
+    duration = time.perf_counter() - start
+    observe(
+        "fw_http_request_duration_seconds",
+        duration,
+        method=request.method,
+        endpoint=request.endpoint or "",
+        status=resp.status_code,
+    )
+    spans = g.get("metric_spans", {})
+    resp.headers["Server-Timing"] = ", ".join(
+        [f"{name};dur={s * 1000:.1f}" for name, s in spans.items()]
+        + [f"total;dur={duration * 1000:.1f}"]
+    )
+    flush()
+    return resp
+
+
+@sa.event.listens_for(sa.engine.Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metric_starts", []).append(time.perf_counter())
+
+
+@sa.event.listens_for(sa.engine.Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["metric_starts"].pop()
+    statement_type = statement.lstrip().split(None, 1)[0].upper() if statement else ""
+    observe("fw_sql_query_duration_seconds", duration, statement=statement_type)
+    _add_span("sql", duration)
+
+
+@sa.event.listens_for(sa.engine.Engine, "handle_error")
+def _handle_error(context):
+    starts = (
+        context.connection.info.get("metric_starts") if context.connection else None
+    )
+    if starts:
+        starts.pop()
+
+
+def init_app(app: Flask) -> None:
+    # scraped by the credentials of the manager, as the metrics are not public
+    from .blueprints.manager import auth
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule("/metrics", "metrics", auth.login_required(metrics_view))
@@ -3,7 +3,7 @@ from datetime import datetime, date
 from typing import Optional, TYPE_CHECKING
 
 import sqlalchemy.orm as so
-from sqlalchemy import func
+from sqlalchemy import ForeignKey, func
 from flask_sqlalchemy import SQLAlchemy
 from flask_sqlalchemy.model import Model
 
@@ -47,6 +47,11 @@ class Base(BaseModel):
             self.__class__.__name__, ",".join(f"{k}={v!r}" for k, v in attrs.items())
         )
 
+    def keep_updated_at(self) -> None:
+        """Leave `updated_at` as it is on the next flush, e.g. for maintenance,
+        which is not an edit."""
+        self.updated_at = type(self).updated_at
+
     def as_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
 
@@ -65,15 +70,64 @@ class Site(Base):
     title: so.Mapped[str]
     description: so.Mapped[Optional[str]]
     no_image_tip: so.Mapped[Optional[str]]
+    # bumped on every change of the catalog, i.e. images or site settings
+    generation: so.Mapped[int] = so.mapped_column(default=0, server_default="0")
+
+
+class ImageStatus:
+    PENDING = "pending"
+    READY = "ready"
+    FAILED = "failed"
+    # rejected by the background ingestion as a near duplicate
+    DUPLICATE = "duplicate"
 
 
 class Image(Base):
+    __table_args__ = (db.Index("ix_image_created_at_id", "created_at", "id"),)
+
     uri: so.Mapped[str] = so.mapped_column(unique=True)
     thumbnail_uri: so.Mapped[str]
-    title: so.Mapped[str]
+    title: so.Mapped[str] = so.mapped_column(unique=True, index=True)
     position: so.Mapped[Optional[str]]
     time: so.Mapped[Optional[str]]
     description: so.Mapped[Optional[str]]
     blurhash: so.Mapped[str]
+    # data URI of a tiny image decoded from the blurhash
+    placeholder: so.Mapped[str] = so.mapped_column(default="", server_default="")
     width: so.Mapped[int]
     height: so.Mapped[int]
+    # SHA-256 of the original, which is also the name of its files
+    content_hash: so.Mapped[Optional[str]] = so.mapped_column(unique=True, index=True)
+    status: so.Mapped[str] = so.mapped_column(
+        default=ImageStatus.READY, server_default=ImageStatus.READY
+    )
+    # settings the derivatives were generated by, see `imaging.derivation_version`
+    derivation: so.Mapped[str] = so.mapped_column(default="", server_default="")
+    # perceptual hash in hex, and its bands to look up near duplicates by,
+    # see `duplicates`
+    phash: so.Mapped[Optional[str]]
+    phash_0: so.Mapped[Optional[int]] = so.mapped_column(index=True)
+    phash_1: so.Mapped[Optional[int]] = so.mapped_column(index=True)
+    phash_2: so.Mapped[Optional[int]] = so.mapped_column(index=True)
+    phash_3: so.Mapped[Optional[int]] = so.mapped_column(index=True)
+
+    renditions: so.Mapped[list["Rendition"]] = so.relationship(
+        back_populates="image",
+        cascade="all, delete-orphan",
+        order_by="Rendition.width",
+    )
+
+
+class Rendition(Base):
+    """A downsized variant of an image, of a certain width and format."""
+
+    image_id: so.Mapped[int] = so.mapped_column(
+        ForeignKey("image.id", ondelete="CASCADE"), index=True
+    )
+    uri: so.Mapped[str] = so.mapped_column(unique=True)
+    width: so.Mapped[int]
+    height: so.Mapped[int]
+    format: so.Mapped[str]
+    size: so.Mapped[int]
+
+    image: so.Mapped[Image] = so.relationship(back_populates="renditions")
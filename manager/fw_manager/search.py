@@ -0,0 +1,142 @@
+"""Full-text search over image info, backed by an SQLite FTS5 table.
+
+The FTS table is kept in sync by mapper events, so every write of `Image`
+goes through it. Other databases fall back to `LIKE` filtering.
+"""
+
+import sqlalchemy as sa
+from flask_sqlalchemy.query import Query
+from sqlalchemy import event
+from sqlalchemy.engine import Connection
+
+from .models import db, Image
+
+FTS_TABLE = "image_fts"
+SEARCH_COLUMNS = ["title", "description", "position", "time"]
+
+_fts = sa.table(FTS_TABLE, sa.column("rowid"), sa.column("rank"))
+
+
+def has_index(conn: Connection) -> bool:
+    if conn.dialect.name != "sqlite":
+        return False
+    return bool(
+        conn.scalar(
+            sa.text("SELECT 1 FROM sqlite_master WHERE type='table' AND name=:name"),
+            {"name": FTS_TABLE},
+        )
+    )
+
+
+def create_index(conn: Connection) -> bool:
+    """Create the FTS table if possible, returns whether it is newly created."""
+    if conn.dialect.name != "sqlite" or has_index(conn):
+        return False
+    conn.execute(
+        sa.text(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            f"{', '.join(SEARCH_COLUMNS)}, tokenize='unicode61 remove_diacritics 2')"
+        )
+    )
+    return True
+
+
+def rebuild_index(conn: Connection) -> int:
+    """Re-populate the FTS table from the image table."""
+    create_index(conn)
+    columns = ", ".join(SEARCH_COLUMNS)
+    conn.execute(sa.text(f"DELETE FROM {FTS_TABLE}"))
+    result = conn.execute(
+        sa.text(
+            f"INSERT INTO {FTS_TABLE} (rowid, {columns}) "
+            f"SELECT id, {columns} FROM {Image.__tablename__}"
+        )
+    )
+    return result.rowcount
+
+
+def _match_expr(keyword: str) -> str:
+    """Every word of the keyword is required, matched as a prefix."""
+    return " ".join('"{}"*'.format(word.replace('"', '""')) for word in keyword.split())
+
+
+def _filter_by_like(query: Query, keyword: str) -> Query:
+    return query.filter(
+        sa.or_(
+            Image.title.contains(keyword),
+            Image.description.contains(keyword),
+            Image.position.contains(keyword),
+            Image.time.contains(keyword),
+        )
+    ).order_by(Image.updated_at.desc())
+
+
+def filter_by_keyword(query: Query, keyword: str) -> Query:
+    """Filter and rank an image query by a keyword.
+
+    Falls back to substring matching when the index finds nothing, e.g. for
+    a keyword in the middle of a word, or of CJK text which has no spaces.
+    """
+    if not keyword.strip():
+        return query.order_by(Image.updated_at.desc())
+    if not has_index(db.session.connection()):
+        return _filter_by_like(query, keyword)
+
+    match = sa.literal_column(FTS_TABLE).op("MATCH")(_match_expr(keyword))
+    matched = db.session.scalar(sa.select(_fts.c.rowid).where(match).limit(1))
+    if matched is None:
+        return _filter_by_like(query, keyword)
+    return (
+        query.join(_fts, _fts.c.rowid == Image.id)
+        .filter(match)
+        .order_by(_fts.c.rank, Image.updated_at.desc())
+    )
+
+
+@event.listens_for(Image.__table__, "after_create")
+def _after_create(target, conn, **kwargs):
+    create_index(conn)
+
+
+@event.listens_for(Image.__table__, "before_drop")
+def _before_drop(target, conn, **kwargs):
+    if conn.dialect.name == "sqlite":
+        conn.execute(sa.text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+
+
+def _values(img: Image) -> dict:
+    return {"id": img.id} | {c: getattr(img, c) for c in SEARCH_COLUMNS}
+
+
+@event.listens_for(Image, "after_insert")
+def _after_insert(mapper, conn, img):
+    if has_index(conn):
+        columns = ", ".join(SEARCH_COLUMNS)
+        params = ", ".join(f":{c}" for c in SEARCH_COLUMNS)
+        conn.execute(
+            sa.text(
+                f"INSERT INTO {FTS_TABLE} (rowid, {columns}) VALUES (:id, {params})"
+            ),
+            _values(img),
+        )
+
+
+@event.listens_for(Image, "after_update")
+def _after_update(mapper, conn, img):
+    state = sa.inspect(img)
+    if not any(state.attrs[c].history.has_changes() for c in SEARCH_COLUMNS):
+        return
+    if has_index(conn):
+        assignments = ", ".join(f"{c} = :{c}" for c in SEARCH_COLUMNS)
+        conn.execute(
+            sa.text(f"UPDATE {FTS_TABLE} SET {assignments} WHERE rowid = :id"),
+            _values(img),
+        )
+
+
+@event.listens_for(Image, "after_delete")
+def _after_delete(mapper, conn, img):
+    if has_index(conn):
+        conn.execute(
+            sa.text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), {"id": img.id}
+        )
@@ -0,0 +1,233 @@
+"""Storage of image files, named by the hash of their content.
+
+Files are addressed by keys relative to the image folder, sharded by the
+prefix of their names, e.g. `ab/cd/abcd...png` for an original and
+`thumbnail/ab/cd/abcd...-1a2b3c4d.png` for its thumbnail, tagged by the
+derivation version it was made by. URIs of images are kept as
+`static/img/<key>` whatever the backend, and files not on the local disk are
+redirected to by the static route.
+"""
+
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, ContextManager, Iterator, cast
+from uuid import uuid4
+
+from flask import Flask, current_app
+
+from .imaging import IMG_FOLDER, RENDITION_FOLDER, THUMBNAIL_FOLDER
+
+CHUNK_SIZE = 64 * 1024
+STAGING_FOLDER = "staging"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+S3_BUCKET = os.environ.get("S3_BUCKET", "")
+S3_PREFIX = os.environ.get("S3_PREFIX", "")
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+S3_PUBLIC_URL = os.environ.get("S3_PUBLIC_URL", "")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class Storage(ABC):
+    """Interface of the backends keeping image files."""
+
+    @abstractmethod
+    def put(self, key: str, src: Path) -> None:
+        """Move a local file into the storage."""
+
+    @abstractmethod
+    def copy(self, src_key: str, dst_key: str) -> None:
+        ...
+
+    @abstractmethod
+    def fetch(self, key: str) -> ContextManager[Path]:
+        """Context manager of a local path of a file, to be read only."""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    def url(self, key: str) -> str | None:
+        """URL to redirect to for a file, if not served from the static folder."""
+        return None
+
+
+class LocalStorage(Storage):
+    def __init__(self, root: Path):
+        self.root = root
+
+    def put(self, key: str, src: Path) -> None:
+        dst = self.root / key
+        dst.parent.mkdir(exist_ok=True, parents=True)
+        shutil.move(src, dst)
+
+    def copy(self, src_key: str, dst_key: str) -> None:
+        dst = self.root / dst_key
+        dst.parent.mkdir(exist_ok=True, parents=True)
+        try:
+            os.link(self.root / src_key, dst)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copy2(self.root / src_key, dst)
+
+    @contextmanager
+    def fetch(self, key: str) -> Iterator[Path]:
+        yield self.root / key
+
+    def delete(self, key: str) -> None:
+        (self.root / key).unlink(missing_ok=True)
+
+    def exists(self, key: str) -> bool:
+        return (self.root / key).is_file()
+
+
+class S3Storage(Storage):
+    """Storage in an S3 compatible bucket, e.g. AWS S3, MinIO or Ceph.
+
+    Requires `boto3`, which is configured by its own environment variables,
+    e.g. `AWS_ACCESS_KEY_ID`. Files are served by `public_url` if the bucket
+    is public, or by presigned URLs otherwise.
+    """
+
+    def __init__(
+        self, bucket: str, prefix="", endpoint_url=None, public_url="", client=None
+    ):
+        if client is None:
+            try:
+                import boto3
+            except ImportError as err:
+                raise RuntimeError("`boto3` is required by the S3 storage.") from err
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url.rstrip("/")
+
+    def put(self, key: str, src: Path) -> None:
+        extra_args = {"CacheControl": IMMUTABLE_CACHE_CONTROL}
+        content_type = mimetypes.guess_type(key)[0]
+        if content_type:
+            extra_args["ContentType"] = content_type
+        self.client.upload_file(
+            str(src), self.bucket, self.prefix + key, ExtraArgs=extra_args
+        )
+        src.unlink()
+
+    def copy(self, src_key: str, dst_key: str) -> None:
+        self.client.copy_object(
+            Bucket=self.bucket,
+            Key=self.prefix + dst_key,
+            CopySource={"Bucket": self.bucket, "Key": self.prefix + src_key},
+        )
+
+    @contextmanager
+    def fetch(self, key: str) -> Iterator[Path]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / Path(key).name
+            self.client.download_file(self.bucket, self.prefix + key, str(path))
+            yield path
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def exists(self, key: str) -> bool:
+        resp = self.client.list_objects_v2(
+            Bucket=self.bucket, Prefix=self.prefix + key, MaxKeys=1
+        )
+        return any(o["Key"] == self.prefix + key for o in resp.get("Contents", []))
+
+    def url(self, key: str) -> str | None:
+        if self.public_url:
+            return f"{self.public_url}/{self.prefix}{key}"
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": self.prefix + key}
+        )
+
+
+def get_storage() -> Storage:
+    return current_app.extensions["fw_storage"]
+
+
+def img_folder() -> Path:
+    return Path(cast(str, current_app.static_folder)) / IMG_FOLDER
+
+
+def staging_folder() -> Path:
+    folder = Path(current_app.instance_path) / STAGING_FOLDER
+    folder.mkdir(exist_ok=True, parents=True)
+    return folder
+
+
+def stage(src: IO[bytes]) -> tuple[Path, str]:
+    """Stream a file into the staging folder, returns its path and SHA-256."""
+    path = staging_folder() / uuid4().hex
+    digest = hashlib.sha256()
+    with path.open("wb") as dst:
+        while chunk := src.read(CHUNK_SIZE):
+            digest.update(chunk)
+            dst.write(chunk)
+    return path, digest.hexdigest()
+
+
+@contextmanager
+def work_folder() -> Iterator[Path]:
+    """A temporary folder, e.g. for derivatives before they are stored."""
+    with tempfile.TemporaryDirectory(dir=staging_folder()) as folder:
+        yield Path(folder)
+
+
+def content_name(content_hash: str, filename: str) -> str:
+    """Name of a file by its content, the suffix is kept to tell its format."""
+    return f"{content_hash}{Path(filename).suffix.lower()}"
+
+
+def shard(name: str) -> str:
+    return f"{name[:2]}/{name[2:4]}/{name}"
+
+
+def img_key(name: str) -> str:
+    return shard(name)
+
+
+def _versioned(name: str, version: str) -> str:
+    """Name of a derivative tagged by the derivation version it was made by, so
+    one made by other settings never goes over a file cached as immutable."""
+    if not version:
+        return name
+    tag = hashlib.sha256(version.encode()).hexdigest()[:8]
+    return f"{Path(name).stem}-{tag}{Path(name).suffix}"
+
+
+def thumbnail_key(name: str, version: str = "") -> str:
+    return f"{THUMBNAIL_FOLDER}/{shard(_versioned(name, version))}"
+
+
+def rendition_key(filename: str, version: str = "") -> str:
+    return f"{RENDITION_FOLDER}/{shard(_versioned(filename, version))}"
+
+
+def uri_of(key: str) -> str:
+    return (img_folder() / key).relative_to(current_app.root_path).as_posix()
+
+
+def key_of(uri: str) -> str:
+    return (Path(current_app.root_path) / uri).relative_to(img_folder()).as_posix()
+
+
+def init_app(app: Flask) -> None:
+    backend: Storage
+    if STORAGE_BACKEND == "s3":
+        backend = S3Storage(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_PUBLIC_URL)
+    else:
+        backend = LocalStorage(Path(cast(str, app.static_folder)) / IMG_FOLDER)
+    app.extensions["fw_storage"] = backend
@@ -0,0 +1,146 @@
+"""Resumable uploads, of originals sent in chunks by many requests.
+
+An upload session is a data file in the staging folder, with its fields in a
+JSON file beside it. Chunks are appended at the offset the client tells, which
+must be the size received so far, so a client resumes after a dropped
+connection by asking for the offset. The data is hashed once, as it is read
+through when the upload is finished, whichever worker received the chunks.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+from typing import IO
+from uuid import uuid4
+
+from loguru import logger
+
+from . import storage
+
+UPLOAD_FOLDER = "uploads"
+UPLOAD_MAX_SIZE = int(os.environ.get("UPLOAD_MAX_SIZE", 200 * 1024 * 1024))
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600))
+
+
+class OffsetMismatchError(Exception):
+    """A chunk is not at the end of the data received so far."""
+
+
+class UploadTooLargeError(Exception):
+    """A chunk goes beyond the size declared by the session."""
+
+
+def upload_folder() -> Path:
+    folder = storage.staging_folder() / UPLOAD_FOLDER
+    folder.mkdir(exist_ok=True)
+    return folder
+
+
+def _is_valid(upload_id: str) -> bool:
+    # ids are uuid4 hex, anything else is not a session, e.g. `../`
+    return bool(re.fullmatch(r"[0-9a-f]{32}", upload_id))
+
+
+def _paths(upload_id: str) -> tuple[Path, Path]:
+    folder = upload_folder()
+    return folder / upload_id, folder / f"{upload_id}.json"
+
+
+def purge_expired() -> None:
+    """Delete sessions without a chunk for `UPLOAD_SESSION_TTL` seconds."""
+    expires = time.time() - UPLOAD_SESSION_TTL
+    for fields_path in upload_folder().glob("*.json"):
+        data_path = fields_path.with_suffix("")
+        try:
+            if data_path.stat().st_mtime >= expires:
+                continue
+        except FileNotFoundError:
+            pass
+        logger.info(f"Upload {data_path.name} expired.")
+        delete(data_path.name)
+
+
+def create(fields: dict, size: int) -> str:
+    """Open a session of an upload of `size` bytes, returns its id."""
+    purge_expired()
+    upload_id = uuid4().hex
+    data_path, fields_path = _paths(upload_id)
+    data_path.touch()
+    fields_path.write_text(json.dumps({**fields, "size": size}))
+    return upload_id
+
+
+def get(upload_id: str) -> dict | None:
+    """Fields of a session, along with its `offset`, or None if not found."""
+    if not _is_valid(upload_id):
+        return None
+    data_path, fields_path = _paths(upload_id)
+    try:
+        fields = json.loads(fields_path.read_text())
+        offset = data_path.stat().st_size
+    except FileNotFoundError:
+        return None
+    return {**fields, "offset": offset}
+
+
+def _get_existing(upload_id: str) -> dict:
+    upload = get(upload_id)
+    if upload is None:
+        raise FileNotFoundError(f"No upload {upload_id}.")
+    return upload
+
+
+def append(upload_id: str, offset: int, src: IO[bytes]) -> int:
+    """Append a chunk at the offset, returns the new offset.
+
+    Whatever is received before a dropped connection is kept, so the client
+    resumes from the offset it is then told.
+    """
+    upload = _get_existing(upload_id)
+    data_path, _ = _paths(upload_id)
+    with data_path.open("r+b") as data:
+        # chunks of the same session are appended one at a time
+        fcntl.flock(data, fcntl.LOCK_EX)
+        current = os.fstat(data.fileno()).st_size
+        if offset != current:
+            raise OffsetMismatchError(current)
+        data.seek(current)
+        try:
+            while chunk := src.read(storage.CHUNK_SIZE):
+                if current + len(chunk) > upload["size"]:
+                    raise UploadTooLargeError(upload["size"])
+                data.write(chunk)
+                current += len(chunk)
+        finally:
+            data.flush()
+            data.truncate(current)
+    return current
+
+
+def finish(upload_id: str) -> tuple[Path, str]:
+    """The file of a complete session linked into the staging folder, with its
+    SHA-256 read through once, as `storage.stage` returns them.
+
+    The session is kept until deleted, so finalizing it may be retried, e.g.
+    after a 503.
+    """
+    _get_existing(upload_id)
+    data_path, _ = _paths(upload_id)
+    staged = storage.staging_folder() / uuid4().hex
+    os.link(data_path, staged)
+    digest = hashlib.sha256()
+    with staged.open("rb") as data:
+        while chunk := data.read(storage.CHUNK_SIZE):
+            digest.update(chunk)
+    return staged, digest.hexdigest()
+
+
+def delete(upload_id: str) -> None:
+    if not _is_valid(upload_id):
+        return
+    for path in _paths(upload_id):
+        path.unlink(missing_ok=True)
@@ -1,10 +1,18 @@
 import time
 
+from . import metrics
+
 
 def make_resp(result=None, err_code="", msg="Success"):
+    metrics.record_response(err_code)
     return {
         "result": result,
         "err_code": err_code,
         "msg": msg,
         "timestamp": int(time.time()),
     }
+
+
+def as_bool(value) -> bool:
+    """Parse a flag from env vars or query args, e.g. `1`, `true`, `yes`."""
+    return str(value).lower() in ["1", "true", "yes", "on"]
@@ -1,6 +1,11 @@
+import io
+import json
+import zipfile
+from datetime import datetime
 from pathlib import Path
 
 import pytest
+from sqlalchemy import text
 
 from fw_manager import models, db
 
@@ -10,6 +15,8 @@ resources = Path(__file__).parent / "resources"
 def test_auth(unauthorized_client):
     resp = unauthorized_client.get("/manager")
     assert resp.status_code == 401
+    resp = unauthorized_client.get("/metrics")
+    assert resp.status_code == 401
 
 
 @pytest.mark.run(order=1)
@@ -33,6 +40,8 @@ def test_add_image(client, app, set_global):
     img_path = root_folder / img.uri
     img_thumbnail_path = root_folder / img.thumbnail_uri
     assert img_path.exists() and img_thumbnail_path.exists()
+    # kept byte for byte
+    assert img_path.read_bytes() == (resources / "picture.png").read_bytes()
 
     set_global("newly_added", newly_added)
 
@@ -54,6 +63,23 @@ def test_add_repeat(client, set_global):
 
 
 @pytest.mark.run(order=3)
+def test_add_repeat_content(client, get_global):
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Upload Test Again",
+            "position": "SH",
+            "time": "2024",
+            "description": "Testing uploading...",
+            "image": ((resources / "picture.png").open("rb"), "again.png"),
+        },
+    )
+    assert resp.status_code == 200
+    assert resp.json["err_code"] == "REPEAT_IMAGE"
+    assert resp.json["result"] == get_global("newly_added")
+
+
+@pytest.mark.run(order=4)
 def test_update_image(client, get_global):
     img = db.session.get(models.Image, get_global("newly_added"))
     assert img
@@ -75,7 +101,7 @@ def test_update_image(client, get_global):
     assert updated_img.title == new_title
 
 
-@pytest.mark.run(order=4)
+@pytest.mark.run(order=5)
 def test_update_repeat(client, get_global, set_global):
     # upload another
     new_title = "Upload Test 2"
@@ -86,7 +112,7 @@ def test_update_repeat(client, get_global, set_global):
             "position": "SH",
             "time": "2024",
             "description": "Testing uploading...",
-            "image": ((resources / "picture.png").open("rb"), "picture.png"),
+            "image": ((resources / "picture-2.png").open("rb"), "picture-2.png"),
         },
     )
     assert resp.status_code == 201
@@ -109,7 +135,29 @@ def test_update_repeat(client, get_global, set_global):
     assert resp.json["err_code"] == "REPEAT_TITLE"
 
 
-@pytest.mark.run(order=5)
+@pytest.mark.run(order=6)
+def test_search_images(client, app):
+    resp = client.get("/manager?keyword=test 3")
+    assert "Upload Test 3" in resp.text and "Upload Test 2" not in resp.text
+
+    resp = client.get("/manager?keyword=Uplo")
+    assert "Upload Test 3" in resp.text and "Upload Test 2" in resp.text
+
+    # kept in sync by add/update
+    indexed = db.session.execute(
+        text("SELECT title FROM image_fts WHERE image_fts MATCH 'test'")
+    ).scalars()
+    assert sorted(indexed) == ["Upload Test 2", "Upload Test 3"]
+
+    result = app.test_cli_runner().invoke(args=["rebuild-search-index"])
+    assert "2 image(s) indexed." in result.output
+
+    # substring matching falls back to `LIKE`
+    resp = client.get("/manager?keyword=pload")
+    assert "Upload Test 3" in resp.text and "Upload Test 2" in resp.text
+
+
+@pytest.mark.run(order=7)
 def test_update_settings(client, set_global):
     resp = client.post(
         "/manager/settings",
@@ -123,7 +171,7 @@ def test_update_settings(client, set_global):
     assert resp.status_code == 200
 
 
-@pytest.mark.run(order=6)
+@pytest.mark.run(order=8)
 def test_retrieve_image(client, get_global):
     resp = client.get("/images")
     assert resp.status_code == 200
@@ -134,7 +182,55 @@ def test_retrieve_image(client, get_global):
     assert resp.json["no_image_tip"] == "Test tip"
 
 
-@pytest.mark.run(order=7)
+@pytest.mark.run(order=9)
+def test_retrieve_image_by_cursor(client):
+    resp = client.get("/images?after=&page_size=1&with_total=1")
+    assert resp.status_code == 200
+    assert resp.json["total"] == 2 and len(resp.json["images"]) == 1
+    first = resp.json["images"][0]
+
+    # edited after it was shown, which never brings it back on a later page
+    img = db.session.get(models.Image, first["id"])
+    img.description = "Edited between pages"
+    img.updated_at = datetime(2100, 1, 1)
+    db.session.commit()
+
+    resp = client.get(f"/images?after={resp.json['next']}&page_size=1")
+    assert resp.status_code == 200
+    assert "total" not in resp.json
+    assert [img["id"] for img in resp.json["images"]] != [first["id"]]
+    assert resp.json["next"] is None
+
+    resp = client.get("/images?after=invalid&page_size=1")
+    assert resp.status_code == 400
+
+
+@pytest.mark.run(order=10)
+def test_retrieve_image_conditionally(client):
+    resp = client.get("/images")
+    etag = resp.headers["ETag"]
+    assert etag and resp.headers["Last-Modified"]
+
+    resp = client.get("/images", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+    img = models.Image.query.first()
+    resp = client.put(
+        f"/manager/images/{img.id}",
+        data={
+            "title": img.title,
+            "position": "SZ",
+            "time": img.time,
+            "description": img.description,
+        },
+    )
+    assert resp.status_code == 200
+
+    resp = client.get("/images", headers={"If-None-Match": etag})
+    assert resp.status_code == 200 and resp.headers["ETag"] != etag
+
+
+@pytest.mark.run(order=11)
 def test_delete_image(client, app, get_global):
     img_id = get_global("newly_added")
     img_id_another = get_global("another_image")
@@ -158,3 +254,1312 @@ def test_delete_image(client, app, get_global):
     img_thumbnail_path_another = root_folder / img_another.thumbnail_uri
     assert not img_path.exists() and not img_thumbnail_path.exists()
     assert not img_path_another.exists() and not img_thumbnail_path_another.exists()
+
+
+def test_add_image_async(client, app, monkeypatch):
+    from fw_manager import ingest
+
+    monkeypatch.setattr(ingest, "INGEST_ASYNC", True)
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Async Upload Test",
+            "position": "SH",
+            "time": "2024",
+            "description": "Testing uploading in background...",
+            "image": ((resources / "picture.png").open("rb"), "picture.png"),
+        },
+    )
+    assert resp.status_code == 202
+    job_id = resp.json["result"]
+
+    ingest.wait(job_id, timeout=10)
+    resp = client.get(f"/manager/images/{job_id}/status")
+    assert resp.json["result"]["status"] == models.ImageStatus.READY
+
+    img = db.session.get(models.Image, job_id)
+    assert img.blurhash and img.width and img.height
+    assert (Path(app.root_path) / img.thumbnail_uri).exists()
+
+    resp = client.delete(f"/manager/images/{job_id}")
+    assert resp.status_code == 204
+
+
+def test_auth_session(unauthorized_client, monkeypatch):
+    from werkzeug.security import generate_password_hash
+    from fw_manager.blueprints import manager
+
+    user = models.User(username="admin", password_hash=generate_password_hash("pwd"))
+    db.session.add(user)
+    db.session.commit()
+
+    checked = []
+    check_password_hash = manager.check_password_hash
+
+    def _check_password_hash(*args):
+        checked.append(args)
+        return check_password_hash(*args)
+
+    monkeypatch.setattr(manager, "check_password_hash", _check_password_hash)
+
+    resp = unauthorized_client.get("/manager", auth=("admin", "wrong"))
+    assert resp.status_code == 401
+
+    for _ in range(3):
+        resp = unauthorized_client.get("/manager", auth=("admin", "pwd"))
+        assert resp.status_code == 200
+    assert len(checked) == 2
+
+    # changing the password revokes the session
+    user.password_hash = generate_password_hash("new")
+    db.session.commit()
+    resp = unauthorized_client.get("/manager", auth=("admin", "pwd"))
+    assert resp.status_code == 401
+
+    db.session.delete(user)
+    db.session.commit()
+
+
+def test_add_images_in_bulk(client):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.write(resources / "picture-2.png", "album/zipped.png")
+        zf.writestr("album/not-an-image.png", b"oops")
+        zf.writestr(
+            "manifest.json",
+            json.dumps(
+                [{"file": "zipped.png", "title": "Bulk Zipped", "time": "2024"}]
+            ),
+        )
+    archive.seek(0)
+
+    resp = client.post(
+        "/manager/images/bulk",
+        data={
+            "manifest": json.dumps([{"file": "c.png", "title": "a"}]),
+            "images": [
+                ((resources / "picture.png").open("rb"), "a.png"),
+                ((resources / "picture.png").open("rb"), "b.png"),
+                ((resources / "picture-2.png").open("rb"), "c.png"),
+                (archive, "album.zip"),
+            ],
+        },
+    )
+    assert resp.status_code == 201
+    results = {r["file"]: r for r in resp.json["result"]}
+    assert results["a.png"]["id"] and results["zipped.png"]["id"]
+    assert results["b.png"]["err_code"] == "REPEAT_IMAGE"
+    assert results["c.png"]["err_code"] == "REPEAT_TITLE"
+    assert results["not-an-image.png"]["err_code"] == "INVALID_IMAGE"
+
+    zipped = db.session.get(models.Image, results["zipped.png"]["id"])
+    assert zipped.title == "Bulk Zipped" and zipped.time == "2024"
+    assert zipped.width == 130 and zipped.blurhash
+
+    for result in results.values():
+        if result["id"]:
+            client.delete(f"/manager/images/{result['id']}")
+
+
+def test_add_images_in_bulk_invalid(client, monkeypatch):
+    for manifest in ["not json", '[{"title": "No file"}]', '{"file": "a.png"}']:
+        resp = client.post("/manager/images/bulk", data={"manifest": manifest})
+        assert resp.status_code == 400
+        assert resp.json["err_code"] == "INVALID_MANIFEST"
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("a.png", b"0" * 1024)
+        zf.writestr("b.png", b"0" * 1024)
+    monkeypatch.setattr("fw_manager.blueprints.manager.ARCHIVE_MAX_SIZE", 1024)
+    archive.seek(0)
+    resp = client.post(
+        "/manager/images/bulk", data={"images": [(archive, "album.zip")]}
+    )
+    assert resp.status_code == 413
+    assert resp.json["err_code"] == "ARCHIVE_TOO_LARGE"
+
+
+def test_add_invalid_image(client):
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Invalid Image",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": (io.BytesIO(b"not an image"), "invalid.png"),
+        },
+    )
+    assert resp.status_code == 200
+    assert resp.json["err_code"] == "INVALID_IMAGE"
+    assert not models.Image.query.filter_by(title="Invalid Image").count()
+
+
+@pytest.mark.parametrize(
+    "filename, truncate",
+    [("truncated.png", True), ("truncated.jpg", True), ("no-extension", False)],
+)
+def test_add_broken_image(client, app, filename, truncate):
+    from PIL import Image as PImage
+    from fw_manager import storage
+
+    buffer = io.BytesIO()
+    PImage.effect_noise((640, 480), 64).save(
+        buffer, "PNG" if "png" in filename else "JPEG"
+    )
+    content = buffer.getvalue()
+    if truncate:
+        content = content[: len(content) // 2]
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Broken Image",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": (io.BytesIO(content), filename),
+        },
+    )
+    assert resp.status_code == 200
+    assert resp.json["err_code"] == "INVALID_IMAGE"
+    assert not models.Image.query.filter_by(title="Broken Image").count()
+    # nothing is left staged
+    with app.app_context():
+        assert not [p for p in storage.staging_folder().iterdir() if p.is_file()]
+
+
+def test_add_too_large_image(client, monkeypatch):
+    from fw_manager import imaging
+
+    monkeypatch.setattr(imaging, "MAX_IMAGE_PIXELS", 100 * 100)
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Too Large Image",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": ((resources / "picture.png").open("rb"), "picture.png"),
+        },
+    )
+    assert resp.status_code == 200
+    assert resp.json["err_code"] == "IMAGE_TOO_LARGE"
+
+
+def test_gen_thumbnail_by_draft(tmp_path, monkeypatch):
+    from PIL import Image as PImage
+    from fw_manager import imaging
+
+    PImage.new("RGB", (4800, 3600), "skyblue").save(tmp_path / "large.jpg")
+    # decoding at full scale would take 4800 * 3600 * 3 bytes
+    monkeypatch.setattr(imaging, "MAX_DECODE_BYTES", 4 * 1024 * 1024)
+    meta = imaging.derive(tmp_path / "large.jpg", tmp_path / "thumbnail.jpg")
+    assert (meta["width"], meta["height"]) == (4800, 3600) and meta["blurhash"]
+    with PImage.open(tmp_path / "thumbnail.jpg") as thumbnail:
+        assert thumbnail.width == imaging.THUMBNAIL_MAX_WIDTH
+
+    PImage.new("RGB", (4800, 3600), "skyblue").save(tmp_path / "large.png")
+    with pytest.raises(imaging.ImageTooLargeError):
+        imaging.derive(tmp_path / "large.png", tmp_path / "thumbnail.png")
+
+
+def test_derive_by_exif_orientation(tmp_path, monkeypatch):
+    from PIL import Image as PImage
+    from fw_manager import imaging
+
+    img = PImage.new("RGB", (1600, 800), "skyblue")
+    exif = img.getexif()
+    # rotated by 90 degrees as shown, i.e. portrait
+    exif[0x0112] = 6
+    img.save(tmp_path / "rotated.jpg", exif=exif)
+    assert imaging.probe(tmp_path / "rotated.jpg") == (800, 1600)
+
+    meta = imaging.derive(
+        tmp_path / "rotated.jpg", tmp_path / "thumbnail.jpg", tmp_path / "renditions"
+    )
+    assert (meta["width"], meta["height"]) == (800, 1600)
+    with PImage.open(tmp_path / "thumbnail.jpg") as thumbnail:
+        assert thumbnail.width == imaging.THUMBNAIL_MAX_WIDTH
+        assert thumbnail.height == imaging.THUMBNAIL_MAX_WIDTH * 2
+    assert all(r["height"] == r["width"] * 2 for r in meta["renditions"])
+
+    imaging.reencode(tmp_path / "rotated.jpg")
+    with PImage.open(tmp_path / "rotated.jpg") as reencoded:
+        assert reencoded.size == (800, 1600)
+
+    # probed by the header only, not decoded
+    opened = []
+
+    def _open(img_path):
+        opened.append(PImage.open(img_path))
+        return opened[-1]
+
+    monkeypatch.setattr(imaging, "_open", _open)
+    img.save(tmp_path / "rotated.png", exif=exif)
+    img.save(tmp_path / "plain.png")
+    assert imaging.probe(tmp_path / "rotated.png") == (800, 1600)
+    assert imaging.probe(tmp_path / "plain.png") == (1600, 800)
+    assert all(pil_img.tile for pil_img in opened)
+
+
+def test_add_image_renditions(client, app):
+    from PIL import Image as PImage
+
+    buffer = io.BytesIO()
+    PImage.new("RGB", (1000, 750), "orange").save(buffer, "JPEG")
+    buffer.seek(0)
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Renditions Test",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": (buffer, "orange.jpg"),
+        },
+    )
+    assert resp.status_code == 201
+    img_id = resp.json["result"]
+
+    resp = client.get("/images")
+    [img] = [img for img in resp.json["images"] if img["id"] == img_id]
+    renditions = img["renditions"]
+    assert [(r["width"], r["height"]) for r in renditions] == [(320, 240), (640, 480)]
+    root_folder = Path(app.root_path)
+    for rendition in renditions:
+        path = root_folder / rendition["uri"]
+        assert path.stat().st_size == rendition["size"]
+
+    client.delete(f"/manager/images/{img_id}")
+    assert not any((root_folder / r["uri"]).exists() for r in renditions)
+
+
+def test_serve_image_files(client, app):
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Serving Test",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": ((resources / "picture.png").open("rb"), "picture.png"),
+        },
+    )
+    img = db.session.get(models.Image, resp.json["result"])
+
+    resp = client.get(f"/{img.uri}", headers={"Range": "bytes=0-9"})
+    assert resp.status_code == 206 and len(resp.data) == 10
+    assert "immutable" in resp.headers["Cache-Control"]
+
+    resp = client.get(f"/{img.uri}", headers={"X-Accel-Offload": "/protected-static/"})
+    assert resp.status_code == 200 and not resp.data
+    assert resp.headers["X-Accel-Redirect"] == f"/protected-{img.uri}"
+    assert resp.mimetype == "image/png"
+
+    resp = client.get("/static/img/missing.png", headers={"X-Accel-Offload": "/x"})
+    assert resp.status_code == 404
+
+    client.delete(f"/manager/images/{img.id}")
+
+
+def test_reshard(client, app):
+    from fw_manager import storage
+
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Reshard Test",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": ((resources / "picture-2.png").open("rb"), "picture.png"),
+        },
+    )
+    img = db.session.get(models.Image, resp.json["result"])
+    name = Path(img.uri).name
+    assert storage.key_of(img.uri) == f"{name[:2]}/{name[2:4]}/{name}"
+
+    # laid out flat, as by earlier versions
+    root_folder = Path(app.root_path)
+    sharded_path = root_folder / img.uri
+    for attr in ["uri", "thumbnail_uri"]:
+        flat_uri = Path(getattr(img, attr)).parent.parent.parent / name
+        (root_folder / getattr(img, attr)).replace(root_folder / flat_uri)
+        setattr(img, attr, flat_uri.as_posix())
+    img.updated_at = datetime(2000, 1, 1)
+    db.session.commit()
+    flat_path = root_folder / img.uri
+
+    result = app.test_cli_runner().invoke(args=["reshard", "--batch-size", "1"])
+    assert result.exit_code == 0
+    db.session.refresh(img)
+    assert img.updated_at == datetime(2000, 1, 1)
+    assert root_folder / img.uri == sharded_path and sharded_path.exists()
+    assert (root_folder / img.thumbnail_uri).exists()
+    assert not flat_path.exists()
+
+    client.delete(f"/manager/images/{img.id}")
+    assert not sharded_path.exists()
+
+
+def test_s3_storage(tmp_path):
+    moto = pytest.importorskip("moto")
+    import boto3
+    from fw_manager.storage import S3Storage
+
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="fine-weather")
+        store = S3Storage("fine-weather", "img/", client=client)
+
+        (tmp_path / "picture.png").write_bytes((resources / "picture.png").read_bytes())
+        store.put("ab/cd/abcd.png", tmp_path / "picture.png")
+        assert not (tmp_path / "picture.png").exists()
+        assert store.exists("ab/cd/abcd.png") and not store.exists("ab/cd/abc")
+
+        store.copy("ab/cd/abcd.png", "thumbnail/ab/cd/abcd.png")
+        with store.fetch("thumbnail/ab/cd/abcd.png") as path:
+            assert path.read_bytes() == (resources / "picture.png").read_bytes()
+        head = client.head_object(Bucket="fine-weather", Key="img/ab/cd/abcd.png")
+        assert head["ContentType"] == "image/png"
+        assert "immutable" in head["CacheControl"]
+
+        assert "img/ab/cd/abcd.png" in store.url("ab/cd/abcd.png")
+        store.public_url = "https://cdn.example.com"
+        assert (
+            store.url("ab/cd/abcd.png") == "https://cdn.example.com/img/ab/cd/abcd.png"
+        )
+
+        store.delete("ab/cd/abcd.png")
+        assert not store.exists("ab/cd/abcd.png")
+
+
+def test_regenerate(client, app):
+    from fw_manager import commands, imaging, storage
+
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Regenerate Test",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": ((resources / "picture-2.png").open("rb"), "picture.png"),
+        },
+    )
+    img = db.session.get(models.Image, resp.json["result"])
+    thumbnail_path = Path(app.root_path) / img.thumbnail_uri
+    thumbnail_path.unlink()
+    img.blurhash = ""
+    db.session.commit()
+
+    # resumed after the checkpoint, which is past the image
+    checkpoint = Path(app.instance_path) / commands.REGENERATE_CHECKPOINT
+    checkpoint.parent.mkdir(exist_ok=True, parents=True)
+    checkpoint.write_text(str(img.id))
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["regenerate"])
+    assert "0 regenerated" in result.output and not checkpoint.exists()
+    assert not thumbnail_path.exists()
+
+    result = runner.invoke(args=["regenerate"])
+    assert result.exit_code == 0 and "1 regenerated" in result.output
+    db.session.refresh(img)
+    assert img.blurhash and thumbnail_path.exists()
+
+    result = runner.invoke(args=["regenerate"])
+    assert "1 skipped" in result.output
+
+    # derived by other settings, which are served from another key
+    old_key = storage.thumbnail_key(Path(img.uri).name, "300;;;80")
+    old_path = storage.img_folder() / old_key
+    old_path.parent.mkdir(parents=True, exist_ok=True)
+    thumbnail_path.replace(old_path)
+    img.thumbnail_uri = storage.uri_of(old_key)
+    img.derivation = "300;;;80"
+    img.updated_at = datetime(2000, 1, 1)
+    db.session.commit()
+    result = runner.invoke(args=["regenerate"])
+    assert "1 regenerated" in result.output
+    db.session.refresh(img)
+    assert img.derivation == imaging.derivation_version()
+    assert img.updated_at == datetime(2000, 1, 1)
+    assert thumbnail_path.exists() and not old_path.exists()
+
+    client.delete(f"/manager/images/{img.id}")
+
+
+def test_images_page_out_of_range(client):
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Page Out Of Range",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": ((resources / "picture.png").open("rb"), "picture.png"),
+        },
+    )
+    assert resp.status_code == 201
+    img_id = resp.json["result"]
+
+    resp = client.get("/manager?page=1000&page_size=1")
+    assert resp.status_code == 302
+    assert resp.location.startswith("/manager?page=1&")
+    client.delete(f"/manager/images/{img_id}")
+
+
+def test_benchmark(app, tmp_path):
+    from fw_manager import benchmark
+
+    runner = app.test_cli_runner()
+    # not seeded unless the database is named
+    result = runner.invoke(args=["seed-benchmark", "--images", "30"])
+    assert result.exit_code != 0 and "--database" in result.output
+    result = runner.invoke(
+        args=["seed-benchmark", "--images", "30", "--database", "sqlite://"]
+    )
+    assert result.exit_code != 0 and "not the configured database" in result.output
+    database = ["--database", "sqlite:///:memory:"]
+    result = runner.invoke(args=["seed-benchmark", "--images", "30", *database])
+    assert "30 image(s) seeded" in result.output
+
+    imaging_results = benchmark.bench_imaging(
+        sizes=[(800, 600)], formats=["jpeg"], repeat=1
+    )
+    assert {r["name"] for r in imaging_results} == {
+        "imaging.thumbnail",
+        "imaging.blurhash",
+        "imaging.save",
+        "imaging.derive",
+    }
+
+    output_path = tmp_path / "benchmark.json"
+    result = runner.invoke(
+        args=["benchmark", "--rows", "30,40", "--repeat", "2", "--skip-imaging"]
+        + ["--output", str(output_path), *database]
+    )
+    assert result.exit_code == 0, result.output
+    output = json.loads(output_path.read_text())
+    assert output["environment"]["database"] == "sqlite"
+    rows = {r["params"]["rows"] for r in output["results"]}
+    assert rows == {30, 40}
+    deep = [r for r in output["results"] if r["params"].get("page") == 4]
+    assert {r["name"] for r in deep} == {
+        "get_images",
+        "images_page",
+        "get_images.cursor",
+    }
+    assert all(r["repeat"] == 2 and r["median_ms"] >= 0 for r in output["results"])
+
+    result = runner.invoke(args=["seed-benchmark", "--clear", *database])
+    assert "40 seeded image(s) deleted" in result.output
+
+
+def test_metrics_of_idle_workers(client, tmp_path, monkeypatch):
+    import os
+    import subprocess
+    import sys
+
+    from fw_manager import metrics
+
+    monkeypatch.setattr(metrics, "METRICS_FOLDER", str(tmp_path))
+    key = (
+        "fw_http_request_duration_seconds",
+        (("endpoint", ""), ("method", "GET"), ("status", 404)),
+    )
+    local_count = metrics._registry.histograms.get(key, [0])[-1]
+
+    # as by other workers, which serve a few requests at once and then idle,
+    # or exit, within the flush interval
+    for interval, idle in [("0.5", "time.sleep(1.5)\nos._exit(0)"), ("60", "")]:
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import os, time\n"
+                "from fw_manager import create_app\n"
+                "client = create_app().test_client()\n"
+                "for _ in range(3):\n"
+                "    client.get('/missing')\n" + idle,
+            ],
+            check=True,
+            cwd=Path(__file__).parent.parent,
+            env=os.environ
+            | {"METRICS_FOLDER": str(tmp_path), "METRICS_FLUSH_INTERVAL": interval},
+        )
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    samples = dict(
+        line.rsplit(" ", 1) for line in resp.text.splitlines() if line[0] != "#"
+    )
+    count = samples[
+        "fw_http_request_duration_seconds_count"
+        '{endpoint="",method="GET",status="404"}'
+    ]
+    assert float(count) == local_count + 6
+
+
+def test_metrics(client, app, tmp_path, monkeypatch):
+    import os
+    import subprocess
+    import sys
+
+    from fw_manager import metrics
+
+    monkeypatch.setattr(metrics, "METRICS_FOLDER", str(tmp_path))
+
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Metrics Test",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": ((resources / "picture.png").open("rb"), "picture.png"),
+        },
+    )
+    assert resp.status_code == 201
+    assert "derive;dur=" in resp.headers["Server-Timing"]
+    assert "sql;dur=" in resp.headers["Server-Timing"]
+    img_id = resp.json["result"]
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Metrics Test",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": ((resources / "picture.png").open("rb"), "picture.png"),
+        },
+    )
+    assert resp.json["err_code"] == "REPEAT_TITLE"
+
+    # as by another worker process
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "from fw_manager import create_app, metrics\n"
+            "with create_app().app_context():\n"
+            "    metrics.inc('fw_image_bytes_total', 1000)\n"
+            "    metrics.flush(force=True)\n",
+        ],
+        check=True,
+        cwd=Path(__file__).parent.parent,
+        env=os.environ | {"METRICS_FOLDER": str(tmp_path)},
+    )
+
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    samples = dict(
+        line.rsplit(" ", 1) for line in resp.text.splitlines() if line[0] != "#"
+    )
+    local_bytes = metrics._registry.counters[("fw_image_bytes_total", ())]
+    assert float(samples["fw_image_bytes_total"]) == local_bytes + 1000
+    assert float(
+        samples[
+            'fw_responses_total{endpoint="manager.add_image",err_code="REPEAT_TITLE"}'
+        ]
+    )
+    for phase in ["stage", "probe", "decode", "blurhash", "save", "commit"]:
+        assert f'fw_ingest_phase_duration_seconds_count{{phase="{phase}"}}' in samples
+    assert (
+        'fw_sql_query_duration_seconds_bucket{statement="SELECT",le="+Inf"}' in samples
+    )
+
+    client.delete(f"/manager/images/{img_id}")
+
+
+def _hammer(db_uri, image_id, rounds, queue):
+    import os
+
+    os.environ["FLASK_SQLALCHEMY_DATABASE_URI"] = db_uri
+    from fw_manager import create_app
+
+    app = create_app()
+    statuses = []
+    try:
+        with app.test_client() as client:
+            for i in range(rounds):
+                resp = client.put(
+                    f"/manager/images/{image_id}",
+                    data={
+                        "title": f"Hammered {image_id}-{i}",
+                        "position": "",
+                        "time": "",
+                        "description": "",
+                    },
+                    auth=("admin", "pwd"),
+                )
+                statuses.append(resp.status_code)
+                statuses.append(client.get("/images?page_size=50").status_code)
+                resp = client.get("/manager?keyword=Hammered", auth=("admin", "pwd"))
+                statuses.append(resp.status_code)
+    finally:
+        queue.put(statuses)
+
+
+def test_sqlite_concurrency(tmp_path):
+    import multiprocessing
+
+    from sqlalchemy import create_engine, select
+    from sqlalchemy.orm import Session
+    from werkzeug.security import generate_password_hash
+
+    db_uri = f"sqlite:///{tmp_path / 'data.db'}"
+    engine = create_engine(db_uri)
+    db.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(models.Site(title="Fine Weather", generation=0))
+        session.add(
+            models.User(username="admin", password_hash=generate_password_hash("pwd"))
+        )
+        images = [
+            models.Image(
+                uri=f"static/img/{i}.png",
+                thumbnail_uri=f"static/img/thumbnail/{i}.png",
+                title=f"Hammered {i}",
+                blurhash="",
+                width=1,
+                height=1,
+            )
+            for i in range(4)
+        ]
+        session.add_all(images)
+        session.commit()
+        image_ids = [img.id for img in images]
+        assert session.scalar(text("PRAGMA journal_mode")) == "wal"
+        generation = session.scalar(select(models.Site.generation))
+
+    rounds = 15
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    workers = [
+        ctx.Process(target=_hammer, args=(db_uri, image_id, rounds, queue))
+        for image_id in image_ids
+    ]
+    for worker in workers:
+        worker.start()
+    statuses = [status for _ in workers for status in queue.get(timeout=120)]
+    for worker in workers:
+        worker.join()
+
+    assert len(statuses) == len(workers) * rounds * 3
+    assert set(statuses) == {200}
+    with Session(engine) as session:
+        # every write is committed once, and bumps the catalog once
+        assert (
+            session.scalar(select(models.Site.generation))
+            == generation + len(workers) * rounds
+        )
+        titles = session.scalars(select(models.Image.title)).all()
+        assert sorted(titles) == [f"Hammered {i}-{rounds - 1}" for i in image_ids]
+    engine.dispose()
+
+
+def test_catalog_snapshot(client, app):
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Snapshot Test",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": ((resources / "picture.png").open("rb"), "picture.png"),
+        },
+    )
+    img_id = resp.json["result"]
+
+    resp = client.get("/images?page_size=100")
+    assert any(img["title"] == "Snapshot Test" for img in resp.json["images"])
+    snapshot = app.extensions["fw_catalog_snapshot"]
+    client.get("/images?page=2")
+    assert app.extensions["fw_catalog_snapshot"] is snapshot
+
+    # written as by another worker, which only bumps the generation
+    db.session.execute(
+        text("UPDATE image SET title = 'Snapshot Renamed' WHERE id = :id"),
+        {"id": img_id},
+    )
+    db.session.execute(text("UPDATE site SET generation = generation + 1"))
+    db.session.commit()
+    resp = client.get("/images?page_size=100")
+    assert any(img["title"] == "Snapshot Renamed" for img in resp.json["images"])
+    assert app.extensions["fw_catalog_snapshot"] is not snapshot
+    [img] = [img for img in resp.json["images"] if img["id"] == img_id]
+    assert img["updated_at"].endswith(" GMT") and img["renditions"] == []
+
+    resp = client.get("/images?page_size=100&fields=id,title,renditions")
+    assert {"id": img_id, "title": "Snapshot Renamed", "renditions": []} in resp.json[
+        "images"
+    ]
+    assert resp.json["total"] >= 1
+    resp = client.get("/images?after=&fields=id")
+    assert all(img.keys() == {"id"} for img in resp.json["images"])
+    resp = client.get("/images?fields=id,password")
+    assert resp.status_code == 400
+
+    client.delete(f"/manager/images/{img_id}")
+
+
+async def _asgi_get(asgi_app, path, query="", headers=()):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+    }
+    await asgi_app(scope, receive, send)
+    start, body = messages
+    headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    return start["status"], headers, body["body"]
+
+
+def test_asgi_retriever(tmp_path, monkeypatch):
+    import asyncio
+
+    pytest.importorskip("aiosqlite")
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    from fw_manager import asgi, create_app, metrics
+
+    db_uri = f"sqlite:///{tmp_path / 'data.db'}"
+    engine = create_engine(db_uri)
+    db.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(models.Site(title="Fine Weather", generation=0))
+        session.add_all(
+            models.Image(
+                uri=f"static/img/{i}.png",
+                thumbnail_uri=f"static/img/thumbnail/{i}.png",
+                title=f"Async {i}",
+                blurhash="",
+                width=1,
+                height=1,
+            )
+            for i in range(25)
+        )
+        session.commit()
+
+    monkeypatch.setenv("FLASK_SQLALCHEMY_DATABASE_URI", db_uri)
+    monkeypatch.setattr(metrics, "METRICS_FOLDER", str(tmp_path / "metrics"))
+    flask_app = create_app()
+    retriever = asgi.Retriever(flask_app)
+
+    async def visit():
+        # as many visitors at once as the pool has connections, and more
+        pages = await asyncio.gather(
+            *(_asgi_get(retriever, "/images", f"page={p % 3 + 1}") for p in range(40))
+        )
+        # the same as the WSGI app answers
+        with flask_app.test_client() as client:
+            for p, (status, _, page) in enumerate(pages):
+                assert status == 200
+                wsgi_resp = client.get(f"/images?page={p % 3 + 1}")
+                assert json.loads(page) == wsgi_resp.json
+        status, headers, body = await _asgi_get(
+            retriever, "/images", "after=&page_size=20&with_total=1&fields=id,title"
+        )
+        not_modified = await _asgi_get(
+            retriever, "/images", headers=[("If-None-Match", headers["etag"])]
+        )
+        errors = [
+            await _asgi_get(retriever, "/images", "fields=password"),
+            await _asgi_get(retriever, "/images", "after=%%%"),
+            await _asgi_get(retriever, "/manager"),
+        ]
+        with Session(engine) as session:
+            session.execute(text("UPDATE image SET title = 'Async Renamed ' || id"))
+            session.execute(text("UPDATE site SET generation = generation + 1"))
+            session.commit()
+        renamed = await _asgi_get(retriever, "/images")
+        await retriever.close()
+        return (status, headers, body), not_modified, errors, renamed
+
+    (status, headers, body), not_modified, errors, renamed = asyncio.run(visit())
+    assert status == 200 and headers["etag"] == '"catalog-0"'
+    page = json.loads(body)
+    assert page["total"] == 25 and len(page["images"]) == 20 and page["next"]
+    assert page["images"][0] == {"id": 1, "title": "Async 0"}
+    assert not_modified[0] == 304 and not_modified[2] == b""
+    assert [status for status, _, _ in errors] == [400, 400, 404]
+    assert json.loads(errors[2][2])["err_code"] == "NOT_FOUND"
+    assert renamed[1]["etag"] == '"catalog-1"'
+    assert all(
+        img["title"] == f"Async Renamed {img['id']}"
+        for img in json.loads(renamed[2])["images"]
+    )
+    engine.dispose()
+
+
+def test_update_images(client, capsys):
+    import click
+    from sqlalchemy import inspect
+
+    from fw_manager import commands
+    from fw_manager.blueprints.manager import _commit_new_image
+
+    indexes = {i["name"]: i for i in inspect(db.engine).get_indexes("image")}
+    assert indexes["ix_image_title"]["unique"]
+
+    ids = []
+    for i, name in enumerate(["picture.png", "picture-2.png"]):
+        resp = client.post(
+            "/manager/images",
+            data={
+                "title": f"Batch {i}",
+                "position": "",
+                "time": "",
+                "description": "",
+                "image": ((resources / name).open("rb"), name),
+            },
+        )
+        ids.append(resp.json["result"])
+
+    resp = client.put(
+        "/manager/images",
+        json=[
+            {"id": ids[0], "title": "Batch Edited 0", "position": "SH"},
+            {"id": ids[1], "description": "Edited in batch"},
+        ],
+    )
+    assert resp.json["result"] == ids and not resp.json["err_code"]
+    first, second = (db.session.get(models.Image, i) for i in ids)
+    assert (first.title, first.position) == ("Batch Edited 0", "SH")
+    assert (second.title, second.description) == ("Batch 1", "Edited in batch")
+
+    # all or nothing
+    resp = client.put(
+        "/manager/images",
+        json=[
+            {"id": ids[0], "position": "BJ"},
+            {"id": ids[1], "title": "Batch Edited 0"},
+        ],
+    )
+    assert resp.json["err_code"] == "REPEAT_TITLE"
+    assert db.session.get(models.Image, ids[0]).position == "SH"
+    resp = client.put("/manager/images", json=[{"id": 0, "title": "Gone"}])
+    assert resp.json["err_code"] == "INVALID_IMAGE" and resp.json["result"] == [0]
+    for edits in [
+        [{"id": ids[0], "uri": "x"}],
+        [{"id": ids[0], "title": None}],
+        [{"id": ids[0], "title": ""}],
+        [{"id": ids[0], "position": 1}],
+        [ids[0]],
+    ]:
+        resp = client.put("/manager/images", json=edits)
+        assert resp.status_code == 400
+
+    resp = client.put(
+        f"/manager/images/{ids[1]}",
+        data={"title": "Batch Edited 0", "position": "", "time": "", "description": ""},
+    )
+    assert resp.json["err_code"] == "REPEAT_TITLE"
+    # as when another worker takes the title in between the check and the commit
+    img = models.Image(
+        uri="static/img/race.png",
+        thumbnail_uri="static/img/thumbnail/race.png",
+        title="Batch Edited 0",
+        blurhash="",
+        width=1,
+        height=1,
+    )
+    assert _commit_new_image(img) == "REPEAT_TITLE"
+
+    # titles repeated before the index was there, e.g. by earlier versions
+    with db.engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_image_title"))
+        conn.execute(
+            text("UPDATE image SET title = 'Batch Edited 0' WHERE id = :id"),
+            {"id": ids[1]},
+        )
+    with pytest.raises(click.ClickException):
+        commands._upgrade_tables()
+    assert "'Batch Edited 0': 2 rows" in capsys.readouterr().out
+    db.session.expire_all()
+    db.session.get(models.Image, ids[1]).title = "Batch 1"
+    db.session.commit()
+    commands._upgrade_tables()
+    indexes = {i["name"]: i for i in inspect(db.engine).get_indexes("image")}
+    assert indexes["ix_image_title"]["unique"]
+
+    for image_id in ids:
+        client.delete(f"/manager/images/{image_id}")
+
+
+# tables as created by the first release, before any column was added
+_BASELINE_SCHEMA = """
+CREATE TABLE user (
+    id INTEGER PRIMARY KEY, created_at DATETIME NOT NULL,
+    updated_at DATETIME NOT NULL, username VARCHAR NOT NULL,
+    password_hash VARCHAR NOT NULL
+);
+CREATE UNIQUE INDEX ix_user_username ON user (username);
+CREATE TABLE site (
+    id INTEGER PRIMARY KEY, created_at DATETIME NOT NULL,
+    updated_at DATETIME NOT NULL, title VARCHAR NOT NULL, description VARCHAR,
+    no_image_tip VARCHAR
+);
+CREATE TABLE image (
+    id INTEGER PRIMARY KEY, created_at DATETIME NOT NULL,
+    updated_at DATETIME NOT NULL, uri VARCHAR NOT NULL UNIQUE,
+    thumbnail_uri VARCHAR NOT NULL, title VARCHAR NOT NULL, position VARCHAR,
+    time VARCHAR, description VARCHAR, blurhash VARCHAR NOT NULL,
+    width INTEGER NOT NULL, height INTEGER NOT NULL
+);
+"""
+
+
+def test_upgrade_tables(tmp_path):
+    import os
+    import sqlite3
+    import subprocess
+    import sys
+
+    db_path = tmp_path / "baseline.db"
+    with sqlite3.connect(db_path) as conn:
+        conn.executescript(_BASELINE_SCHEMA)
+        conn.executemany(
+            "INSERT INTO image (created_at, updated_at, uri, thumbnail_uri, title,"
+            " blurhash, width, height) VALUES (datetime(), datetime(), ?, ?, ?,"
+            " '', 1, 1)",
+            [
+                (f"static/img/{i}.png", f"static/img/t/{i}.png", f"Old {i}")
+                for i in "123"
+            ],
+        )
+
+    # no content hash of any image yet, which is not a repetition
+    result = subprocess.run(
+        [sys.executable, "-m", "flask", "--app", "fw_manager:create_app"]
+        + ["create-tables", "--username", "admin", "--password", "pwd"],
+        capture_output=True,
+        text=True,
+        cwd=Path(__file__).parent.parent,
+        env=os.environ | {"FLASK_SQLALCHEMY_DATABASE_URI": f"sqlite:///{db_path}"},
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "Skipping" not in result.stdout and "Tables created" in result.stdout
+    with sqlite3.connect(db_path) as conn:
+        indexes = dict(conn.execute("SELECT name, sql FROM sqlite_master"))
+        assert "UNIQUE" in indexes["ix_image_content_hash"]
+        assert "UNIQUE" in indexes["ix_image_title"]
+        assert conn.execute("SELECT username FROM user").fetchall() == [("admin",)]
+
+
+def test_near_duplicates(client, tmp_path, monkeypatch):
+    from PIL import Image as PImage
+
+    from fw_manager import duplicates, ingest
+
+    # resized and recompressed, as photographers upload again
+    with PImage.open(resources / "picture.png") as pil_img:
+        pil_img.convert("RGB").resize((100, 100)).save(tmp_path / "resized.jpg")
+
+    def _upload(title, path, **extra):
+        return client.post(
+            "/manager/images",
+            data={
+                "title": title,
+                "position": "",
+                "time": "",
+                "description": "",
+                "image": (path.open("rb"), path.name),
+            }
+            | extra,
+        )
+
+    original_id = _upload("Near Original", resources / "picture.png").json["result"]
+    original = db.session.get(models.Image, original_id)
+    assert original.phash and original.phash_0 == duplicates.bands(original.phash)[0]
+
+    resp = _upload("Near Resized", tmp_path / "resized.jpg")
+    assert resp.json["err_code"] == "NEAR_DUPLICATE"
+    assert resp.json["result"] == original_id
+    # checked by the background ingestion, once the image is derived
+    monkeypatch.setattr(ingest, "INGEST_ASYNC", True)
+    resp = _upload("Near Resized", tmp_path / "resized.jpg")
+    assert resp.status_code == 202
+    ingest.wait(resp.json["result"], timeout=10)
+    rejected = db.session.get(models.Image, resp.json["result"])
+    assert rejected.status == models.ImageStatus.DUPLICATE
+    client.delete(f"/manager/images/{rejected.id}")
+    monkeypatch.setattr(ingest, "INGEST_ASYNC", False)
+
+    resp = _upload("Near Resized", tmp_path / "resized.jpg", allow_near_duplicate="1")
+    assert resp.status_code == 201
+    resized_id = resp.json["result"]
+    other_id = _upload("Near Other", resources / "picture-2.png").json["result"]
+    [(near_id, _)] = duplicates.find_near(original.phash, exclude_id=original_id)
+    assert near_id == resized_id
+
+    resp = client.get("/manager/duplicates")
+    [group] = [g for g in resp.json["result"] if original_id in {i["id"] for i in g}]
+    assert {img["id"] for img in group} == {original_id, resized_id}
+    assert group[0]["title"] == "Near Original"
+    assert all(other_id not in {i["id"] for i in g} for g in resp.json["result"])
+
+    for image_id in [original_id, resized_id, other_id]:
+        client.delete(f"/manager/images/{image_id}")
+
+
+def test_placeholder(client):
+    resp = client.post(
+        "/manager/images",
+        data={
+            "title": "Placeholder Test",
+            "position": "",
+            "time": "",
+            "description": "",
+            "image": ((resources / "picture.png").open("rb"), "picture.png"),
+        },
+    )
+    img_id = resp.json["result"]
+    img = db.session.get(models.Image, img_id)
+    assert img.placeholder.startswith("data:image/webp;base64,")
+    assert len(img.placeholder) < 1000
+
+    resp = client.get("/images?page_size=100&fields=id,placeholder")
+    assert {"id": img_id, "placeholder": img.placeholder} in resp.json["images"]
+
+    # ingested before placeholders, which are decoded from the blurhash then
+    placeholder = img.placeholder
+    db.session.execute(
+        text("UPDATE image SET placeholder = '' WHERE id = :id"), {"id": img_id}
+    )
+    db.session.execute(text("UPDATE site SET generation = generation + 1"))
+    db.session.commit()
+    resp = client.get("/images?page_size=100&fields=id,placeholder")
+    assert {"id": img_id, "placeholder": placeholder} in resp.json["images"]
+
+    resp = client.get(f"/images/{img_id}/placeholder")
+    assert resp.status_code == 200 and resp.mimetype == "image/webp"
+    assert resp.data.startswith(b"RIFF") and resp.cache_control.max_age
+    resp = client.get(
+        f"/images/{img_id}/placeholder", headers={"If-None-Match": resp.headers["ETag"]}
+    )
+    assert resp.status_code == 304
+    assert client.get("/images/0/placeholder").status_code == 404
+
+    client.delete(f"/manager/images/{img_id}")
+
+
+def test_manifest(client):
+    import gzip
+    import importlib.util
+
+    images = [
+        models.Image(
+            uri=f"static/img/manifest/{i}.png",
+            thumbnail_uri=f"static/img/manifest/thumbnail/{i}.png",
+            title=f"Manifest {i}",
+            blurhash="",
+            width=640,
+            height=480,
+            renditions=[
+                models.Rendition(
+                    uri=f"static/img/manifest/{i}_{w}.webp",
+                    width=w,
+                    height=w * 3 // 4,
+                    format="webp",
+                    size=100,
+                )
+                for w in [640, 320][: i % 3]
+            ],
+        )
+        for i in range(5)
+    ]
+    db.session.add_all(images)
+    db.session.commit()
+    ids = [img.id for img in images]
+
+    resp = client.get("/images/manifest")
+    assert resp.is_streamed and resp.mimetype == "application/x-ndjson"
+    assert "Content-Encoding" not in resp.headers
+    site, *lines = [json.loads(line) for line in resp.data.decode().splitlines()]
+    assert site["site_title"] and "generation" in site
+    assert [img["id"] for img in lines] == sorted(img["id"] for img in lines)
+    by_id = {img["id"]: img for img in lines}
+    for i, image_id in enumerate(ids):
+        assert by_id[image_id]["title"] == f"Manifest {i}"
+        assert [r["width"] for r in by_id[image_id]["renditions"]] == sorted(
+            [640, 320][: i % 3]
+        )
+
+    # resumed after the last image received
+    resp = client.get(f"/images/manifest?after_id={ids[2]}&fields=title")
+    lines = [json.loads(line) for line in resp.data.decode().splitlines()[1:]]
+    assert lines == [
+        {"id": ids[3], "title": "Manifest 3"},
+        {"id": ids[4], "title": "Manifest 4"},
+    ]
+
+    resp = client.get("/images/manifest", headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in resp.headers["Vary"]
+    assert gzip.decompress(resp.data) == client.get("/images/manifest").data
+    # validated by the encoding it was sent in
+    gzip_etag = resp.headers["ETag"]
+    resp = client.get("/images/manifest", headers={"If-None-Match": gzip_etag})
+    assert resp.status_code == 200 and resp.headers["ETag"] != gzip_etag
+    resp = client.get(
+        "/images/manifest",
+        headers={"If-None-Match": gzip_etag, "Accept-Encoding": "gzip"},
+    )
+    assert resp.status_code == 304
+    if importlib.util.find_spec("brotli"):
+        import brotli
+
+        resp = client.get("/images/manifest", headers={"Accept-Encoding": "br, gzip"})
+        assert resp.headers["Content-Encoding"] == "br"
+        assert brotli.decompress(resp.data) == client.get("/images/manifest").data
+
+        resp = client.get(
+            "/images/manifest",
+            headers={"If-None-Match": resp.headers["ETag"], "Accept-Encoding": "br"},
+        )
+        assert resp.status_code == 304
+
+    for img in images:
+        db.session.delete(img)
+    db.session.commit()
+
+
+def test_admission(client, tmp_path, monkeypatch):
+    import threading
+    import time
+
+    from PIL import Image as PImage
+    from fw_manager import admission, ingest
+
+    monkeypatch.setattr(admission, "ADMISSION_FOLDER", str(tmp_path))
+    monkeypatch.setattr(admission, "ADMISSION_SLOTS", 1)
+    monkeypatch.setattr(admission, "ADMISSION_TIMEOUT", 0.2)
+    monkeypatch.setattr(admission, "ADMISSION_RETRY_AFTER", 3)
+
+    def _upload():
+        buf = io.BytesIO()
+        PImage.effect_noise((64, 48), 64).save(buf, "PNG")
+        buf.seek(0)
+        return client.post(
+            "/manager/images",
+            data={
+                "title": "Admitted Image",
+                "position": "",
+                "time": "",
+                "description": "",
+                "image": (buf, "noise.png"),
+            },
+        )
+
+    with admission.admit(1):
+        resp = _upload()
+        assert resp.status_code == 503
+        assert resp.json["err_code"] == "SERVICE_BUSY"
+        assert resp.headers["Retry-After"] == "3"
+
+        # a decode waiting in another thread
+        def _wait():
+            with admission.admit(1, timeout=5):
+                pass
+
+        waiter = threading.Thread(target=_wait)
+        waiter.start()
+        time.sleep(0.2)
+        # told without taking the slots
+        locked = []
+        lock = admission._lock
+
+        def _lock(path):
+            # the waiter keeps trying the slots
+            if threading.current_thread() is not waiter:
+                locked.append(path.name)
+            return lock(path)
+
+        monkeypatch.setattr(admission, "_lock", _lock)
+        resp = client.get("/manager/admission")
+        assert resp.json["result"] == {"slots": 1, "in_use": 1, "waiting": 1}
+        assert locked and not [name for name in locked if name.startswith("slot-")]
+        monkeypatch.setattr(admission, "_lock", lock)
+        assert "fw_admission_waiting 1" in client.get("/metrics").text
+    waiter.join()
+
+    resp = _upload()
+    assert resp.status_code == 201
+    img = db.session.get(models.Image, resp.json["result"])
+    assert client.get("/manager/admission").json["result"]["in_use"] == 0
+    db.session.delete(img)
+    db.session.commit()
+
+    # derives of the process pool are admitted too, waiting as long as it takes
+    PImage.effect_noise((64, 48), 64).save(tmp_path / "noise.png")
+    (tmp_path / "work").mkdir()
+    args = [ingest.derive_args(tmp_path / "noise.png", tmp_path / "work")]
+    results = []
+    with admission.admit(1):
+        deriver = threading.Thread(
+            target=lambda: results.extend(ingest.derive_many(args))
+        )
+        deriver.start()
+        time.sleep(0.5)
+        assert not results and admission.state()["waiting"] == 1
+    deriver.join()
+    assert results[0]["width"] == 64
+
+
+def test_chunked_upload(client):
+    import hashlib
+
+    from PIL import Image as PImage
+
+    buf = io.BytesIO()
+    PImage.effect_noise((96, 64), 64).save(buf, "PNG")
+    content = buf.getvalue()
+    half = len(content) // 2
+
+    resp = client.post(
+        "/manager/uploads",
+        data={"title": "Chunked Upload", "filename": "noise.png", "size": len(content)},
+    )
+    assert resp.status_code == 201
+    upload_id = resp.json["result"]["id"]
+
+    resp = client.put(f"/manager/uploads/{upload_id}?offset=0", data=content[:half])
+    assert resp.json["result"]["offset"] == half
+    resp = client.put(f"/manager/uploads/{upload_id}?offset=0", data=content[:half])
+    assert resp.json["err_code"] == "OFFSET_MISMATCH" and resp.json["result"] == half
+    resp = client.post(f"/manager/uploads/{upload_id}/finalize")
+    assert resp.json["err_code"] == "INCOMPLETE_UPLOAD"
+
+    # resumed at the offset received so far
+    offset = client.get(f"/manager/uploads/{upload_id}").json["result"]["offset"]
+    resp = client.put(
+        f"/manager/uploads/{upload_id}?offset={offset}", data=content[offset:] + b"x"
+    )
+    assert resp.json["err_code"] == "IMAGE_TOO_LARGE"
+    resp = client.put(
+        f"/manager/uploads/{upload_id}?offset={offset}", data=content[offset:]
+    )
+    assert resp.json["result"]["offset"] == len(content)
+
+    resp = client.post(f"/manager/uploads/{upload_id}/finalize")
+    assert resp.status_code == 201
+    img = db.session.get(models.Image, resp.json["result"])
+    assert img.title == "Chunked Upload" and (img.width, img.height) == (96, 64)
+    assert img.content_hash == hashlib.sha256(content).hexdigest()
+    assert client.get(f"/manager/uploads/{upload_id}").status_code == 404
+    db.session.delete(img)
+    db.session.commit()